@@ -0,0 +1,28 @@
+import matplotlib.pyplot as plt
+import numpy as np
+
+from audio_handling import get_pitch_beat
+
+# Debugging helpers for looking at analysis output. Not imported by the game, so
+# matplotlib stays an optional dependency.
+
+def print_pitch_range(times, pitches):
+    # Find the maximum and minimum values
+    max_value = np.max(pitches)
+    min_value = np.min(pitches)
+
+    print(f"max: {max_value} min: {min_value}")
+    print(list(zip(times, pitches)))
+
+def plot_pitch(times, pitches):
+    plt.plot(times, pitches, marker='o')
+    plt.xlabel('Time')
+    plt.ylabel('Pitch')
+    plt.title('Time vs Pitch in Song')
+    plt.show()
+
+if __name__ == "__main__":
+    path = 'audio/field.wav'
+    times, pitches = get_pitch_beat(path)
+    print_pitch_range(times, pitches)
+    plot_pitch(times, pitches)
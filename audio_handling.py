@@ -1,166 +1,442 @@
-import librosa
+import importlib.util
+import sys
+from functools import cached_property
+
 import numpy as np
-import time
-from collections import OrderedDict
-import matplotlib.pyplot as plt
 
-t1 = time.time()
+from chart import in_window, select_events
+from chart_file import is_chart_file, load_chart
+import perf
 
-# Checks if audio file inserted has vocal lyrics. If not, return False.
-def is_vocal(audio_data, sampling_rate):
-    # Perform Harmonic-Percussive Source Separation (HPSS)
-    harmonic, percussive = librosa.effects.hpss(audio_data)
+# librosa takes longer to import than the rest of the game put together, so it is
+# only really imported the first time one of its attributes is used (i.e. when an
+# analysis actually runs). Plotting/debug helpers live in audio_debug.py.
+def _lazy_import(name):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
 
-    # Extract spectral features for the harmonic component
-    spectral_centroid = librosa.feature.spectral_centroid(y=harmonic, sr=sampling_rate)[0]
-    spectral_rolloff = librosa.feature.spectral_rolloff(y=harmonic, sr=sampling_rate)[0]
-    spectral_flatness = librosa.feature.spectral_flatness(y=harmonic)[0]
-    
-    sc_mean = np.mean(spectral_centroid)
-    sr_mean = np.mean(spectral_rolloff)
-    sf_mean = np.mean(spectral_flatness)
+librosa = _lazy_import("librosa")
+
+# Analysis profiles. Audio is always decoded to mono float32; each profile picks
+# the rate it is resampled to (and how carefully), the STFT size and hop, the
+# frequency range piptrack searches and the pitch estimator (see PITCH_ESTIMATORS),
+# plus how many frames either side of an event local_pitch also looks at.
+# "fast" halves the sample rate and FFT size but keeps the same ~23 ms hop, so
+# event timing resolution is unchanged; "balanced" matches librosa's defaults.
+# Profile parameters are part of the chart cache key, so changing any of them
+# invalidates previously cached charts.
+PROFILES = {
+    "fast": {"sr": 11025, "n_fft": 1024, "hop_length": 256, "fmin": 150.0, "fmax": 2000.0, "res_type": "soxr_lq",
+             "pitch": "local", "pitch_width": 0},
+    "balanced": {"sr": 22050, "n_fft": 2048, "hop_length": 512, "fmin": 150.0, "fmax": 4000.0, "res_type": "soxr_hq",
+                 "pitch": "local", "pitch_width": 0},
+    "accurate": {"sr": 44100, "n_fft": 4096, "hop_length": 512, "fmin": 75.0, "fmax": 8000.0, "res_type": "soxr_vhq",
+                 "pitch": "local", "pitch_width": 0},
+}
+DEFAULT_PROFILE = "balanced"
+ANALYSIS_PARAMS = PROFILES[DEFAULT_PROFILE]
+
+# Seconds of audio decoded on each side of an analysis window, so beat tracking
+# has a few beats of context at the window edges
+WINDOW_CONTEXT = 5.0
+
+# Shared analysis of one song. The file is decoded once and the STFT and onset
+# strength envelope are computed once; beat tracking, onset detection and pitch
+# tracking all read from those results, and each is only computed when first used.
+#
+# With offset/duration only that part of the song (plus WINDOW_CONTEXT either
+# side) is decoded and analyzed. Times are always song-absolute, and events only
+# come from inside the window.
+class SongAnalysis:
+    @perf.timed("analysis.load")
+    def __init__(self, audio_path, sr=22050, n_fft=2048, hop_length=512, fmin=150.0, fmax=4000.0,
+                 res_type="soxr_hq", pitch="local", pitch_width=0, offset=0.0, duration=None):
+        self.audio_path = audio_path
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.fmin = fmin
+        self.fmax = fmax
+        self.pitch_estimator = PITCH_ESTIMATORS[pitch]
+        self.pitch_width = pitch_width
+        self.offset = offset
+        self.duration = duration
+        # Song time of the first decoded sample, on the same frame grid as a
+        # whole-song analysis so window events land on the same frames
+        hop_seconds = hop_length / sr
+        self.start = max(0, int((offset - WINDOW_CONTEXT) // hop_seconds)) * hop_seconds
+        load_duration = None if duration is None else offset + duration + WINDOW_CONTEXT - self.start
+        self.y, self.sr = librosa.load(audio_path, sr=sr, mono=True, dtype=np.float32, res_type=res_type,
+                                       offset=self.start, duration=load_duration)
+
+    @cached_property
+    @perf.timed("analysis.spectrum")
+    def spectrum(self):
+        # Magnitude STFT shared by the onset envelope and piptrack
+        return np.abs(librosa.stft(self.y, n_fft=self.n_fft, hop_length=self.hop_length))
+
+    @cached_property
+    @perf.timed("analysis.onset_envelope")
+    def onset_envelope(self):
+        # Same mel/dB pipeline onset_strength uses internally, but fed from the shared STFT.
+        # n_fft and hop_length set the centering lag onset_strength adds, so they must
+        # match the STFT or events come out early for larger FFT sizes.
+        mel = librosa.feature.melspectrogram(S=self.spectrum ** 2, sr=self.sr)
+        return librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=self.sr, n_fft=self.n_fft,
+                                            hop_length=self.hop_length)
+
+    @cached_property
+    @perf.timed("analysis.beat_frames")
+    def beat_frames(self):
+        tempo, beats = librosa.beat.beat_track(onset_envelope=self.onset_envelope, sr=self.sr,
+                                               hop_length=self.hop_length)
+        return beats
+
+    @cached_property
+    @perf.timed("analysis.onset_frames")
+    def onset_frames(self):
+        return librosa.onset.onset_detect(onset_envelope=self.onset_envelope, sr=self.sr,
+                                          hop_length=self.hop_length)
+
+    @cached_property
+    @perf.timed("analysis.pitches")
+    def pitches(self):
+        pitches, _ = librosa.piptrack(S=self.spectrum, sr=self.sr, n_fft=self.n_fft,
+                                      hop_length=self.hop_length, fmin=self.fmin, fmax=self.fmax)
+        return pitches
+
+    @cached_property
+    def frame_pitch(self):
+        # Strongest pitch in each frame; events only ever read this column maximum
+        return self.pitches.max(axis=0)
+
+    @cached_property
+    @perf.timed("analysis.events")
+    def events(self):
+        # Every beat and onset once, with their pitch and which detector found them.
+        # All difficulties are charted from this (see chart.select_events).
+        frames = np.union1d(self.beat_frames, self.onset_frames)
+        frames = frames[in_window(self.frames_to_time(frames), self.offset, self.duration)]
+        return (self.frames_to_time(frames), self.pitch_at_frames(frames),
+                np.isin(frames, self.beat_frames), np.isin(frames, self.onset_frames))
+
+    def pitch_at_frames(self, frames):
+        frames = np.clip(frames, 0, self.spectrum.shape[1] - 1)
+        return self.pitch_estimator(self, frames)
+
+    def frames_to_time(self, frames):
+        return self.start + librosa.frames_to_time(frames, sr=self.sr, hop_length=self.hop_length)
 
-    # Threshold values for each feature to determine if it's vocal or instrumental
-    centroid_threshold = 1250  # Adjust this value based on your analysis
-    rolloff_threshold = 2250  # Adjust this value based on your analysis
-    flatness_threshold = 0.001   # Adjust this value based on your analysis
+    def time_to_frames(self, times):
+        return librosa.time_to_frames(np.asarray(times) - self.start, sr=self.sr, hop_length=self.hop_length)
+
+# Pitch estimators. Each takes an analysis and an array of frame indices and returns
+# one float32 value per frame; only the ordering of the values matters, since the
+# chart quantizes them into lanes.
+
+# Full-song piptrack matrix, read at the event frames
+def piptrack_pitch(analysis, frames):
+    return analysis.frame_pitch[frames]
+
+# piptrack over only the STFT columns at the events. piptrack thresholds and
+# interpolates each column on its own, so this gives the same values as
+# piptrack_pitch without building the bins x frames matrix for the whole song.
+# With the analysis' pitch_width > 0 each event takes the strongest pitch over the
+# frames that far either side of it, centered on the event.
+def local_pitch(analysis, frames):
+    frames = np.asarray(frames)
+    width = analysis.pitch_width
+    columns = np.clip(frames[:, None] + np.arange(-width, width + 1), 0, analysis.spectrum.shape[1] - 1)
+    pitches, _ = librosa.piptrack(S=analysis.spectrum[:, columns.ravel()], sr=analysis.sr, n_fft=analysis.n_fft,
+                                  hop_length=analysis.hop_length, fmin=analysis.fmin, fmax=analysis.fmax)
+    return pitches.max(axis=0).reshape(len(frames), 2 * width + 1).max(axis=1)
+
+# Spectral centroid ("brightness") of the event frames
+def centroid_pitch(analysis, frames):
+    centroid = librosa.feature.spectral_centroid(S=analysis.spectrum[:, frames], sr=analysis.sr, n_fft=analysis.n_fft)
+    return centroid[0].astype(np.float32)
+
+# Strongest pitch class (0-11) of the event frames
+def chroma_pitch(analysis, frames):
+    chroma = librosa.feature.chroma_stft(S=analysis.spectrum[:, frames] ** 2, sr=analysis.sr, n_fft=analysis.n_fft)
+    return chroma.argmax(axis=0).astype(np.float32)
+
+PITCH_ESTIMATORS = {
+    "piptrack": piptrack_pitch,
+    "local": local_pitch,
+    "centroid": centroid_pitch,
+    "chroma": chroma_pitch,
+}
+
+# Accepts either a path or an existing SongAnalysis so callers can share one analysis.
+# A path is analyzed with the given profile (over the given window, see
+# SongAnalysis); an existing analysis keeps its own.
+def get_analysis(source, profile=DEFAULT_PROFILE, offset=0.0, duration=None):
+    if isinstance(source, SongAnalysis):
+        return source
+    return SongAnalysis(source, **PROFILES[profile], offset=offset, duration=duration)
+
+# Threshold values for each feature to determine if it's vocal or instrumental
+VOCAL_THRESHOLDS = {
+    "centroid": 1250,  # Adjust this value based on your analysis
+    "rolloff": 2250,  # Adjust this value based on your analysis
+    "flatness": 0.001,  # Adjust this value based on your analysis
+}
+
+# Mean spectral features of the harmonic part of one or more magnitude spectrograms,
+# plus whether any of them crosses its vocal threshold
+def vocal_features(spectra, sr, n_fft):
+    # Perform Harmonic-Percussive Source Separation (HPSS) on each spectrogram
+    harmonic = np.hstack([librosa.decompose.hpss(spectrum)[0] for spectrum in spectra])
+
+    # Extract spectral features for the harmonic component
+    scores = {
+        "centroid": float(np.mean(librosa.feature.spectral_centroid(S=harmonic, sr=sr, n_fft=n_fft))),
+        "rolloff": float(np.mean(librosa.feature.spectral_rolloff(S=harmonic, sr=sr, n_fft=n_fft))),
+        "flatness": float(np.mean(librosa.feature.spectral_flatness(S=harmonic, n_fft=n_fft))),
+    }
 
     # Check if any of the features indicate vocals
-    is_vocal = (sc_mean > centroid_threshold) or \
-            (sr_mean > rolloff_threshold) or \
-            (sf_mean > flatness_threshold)
-    
-    
-    if is_vocal:
-        print(f"The song is likely to have vocals.\nSC: {sc_mean}\nSR: {sr_mean}\nSF: {sf_mean}")
-    else:
-        print(f"The song is likely to be instrumental.\nSC: {sc_mean}\nSR: {sr_mean}\nSF: {sf_mean}")
-    
-    return is_vocal
+    scores["is_vocal"] = any(scores[name] > threshold for name, threshold in VOCAL_THRESHOLDS.items())
+    return scores
+
+# Start times of `excerpts` windows of `excerpt_length` seconds spread evenly over
+# the song, or a single window covering the song if it is too short for that
+def excerpt_starts(duration, excerpts, excerpt_length):
+    if duration <= excerpts * excerpt_length:
+        return [0.0], duration
+    return [(k + 0.5) * duration / excerpts - excerpt_length / 2 for k in range(excerpts)], excerpt_length
 
-# get song data based on difficulty chosen
-# easy: onset data and/or beat times, very slow paced
-# medium: just beat times?, slow paced
-# hard: beat times and onset data, medium paced
-# expert: beat times and onset data, random bpm, fast paced
+# Vocal detection from a few short excerpts instead of the whole song. Given a
+# SongAnalysis it reuses the STFT already computed for the chart; given a path it
+# decodes only the excerpts. Returns the feature scores from vocal_features.
+def vocal_scores(source, excerpts=3, excerpt_length=10.0, profile=DEFAULT_PROFILE):
+    if isinstance(source, SongAnalysis):
+        analysis = source
+        starts, length = excerpt_starts(len(analysis.y) / analysis.sr, excerpts, excerpt_length)
+        frames_per_second = analysis.sr / analysis.hop_length
+        spectra = [analysis.spectrum[:, int(start * frames_per_second):int((start + length) * frames_per_second) + 1]
+                   for start in starts]
+        return vocal_features(spectra, analysis.sr, analysis.n_fft)
+
+    params = PROFILES[profile]
+    starts, length = excerpt_starts(librosa.get_duration(path=source), excerpts, excerpt_length)
+    spectra = []
+    for start in starts:
+        y, sr = librosa.load(source, sr=params["sr"], offset=start, duration=length, res_type=params["res_type"])
+        spectra.append(np.abs(librosa.stft(y, n_fft=params["n_fft"], hop_length=params["hop_length"])))
+    return vocal_features(spectra, params["sr"], params["n_fft"])
+
+# Checks if audio file inserted has vocal lyrics. If not, return False.
+# Uses the whole signal; vocal_scores is the cheaper excerpt-based version.
+def is_vocal(audio_data, sampling_rate, profile=DEFAULT_PROFILE):
+    spectrum = np.abs(librosa.stft(audio_data, n_fft=PROFILES[profile]["n_fft"],
+                                   hop_length=PROFILES[profile]["hop_length"]))
+    return vocal_features([spectrum], sampling_rate, PROFILES[profile]["n_fft"])["is_vocal"]
+
+# get song data based on difficulty chosen (see chart.DIFFICULTY_SETTINGS)
+# easy: beat times
+# medium: onset times
+# hard: beat times and thinned onsets, medium paced
+# expert: beat times and onsets, lightly thinned, fast paced
 # impossible: beat times and onset data, with maximum bpm and speed
-def get_song_data(audio_path: str, difficulty: str):    
-    match difficulty:
-        case "easy":
-            return get_pitch_beat(audio_path)
-        case "medium":
-            return get_pitch_onset(audio_path)
-        case "hard":
-            pass
-        case "expert":
-            pass
-        case "impossible":
-            return get_pitch_all(audio_path)
+#
+# All difficulties are picked from the same analysis events, so a SongAnalysis
+# passed in as audio_path can be reused for every difficulty.
+#
+# audio_path may also be a chart file (see chart_file.py), in which case the chart's
+# own times and pitches are returned and difficulty/profile are ignored.
+#
+# offset/duration (seconds) limit the result to that part of the song, and only
+# that part is decoded and analyzed; times stay song-absolute.
+def get_song_data(audio_path: str, difficulty: str, profile: str = DEFAULT_PROFILE, offset: float = 0.0,
+                  duration: float = None):
+    if is_chart_file(audio_path):
+        header, timeline = load_chart(audio_path)
+        window = in_window(timeline.times, offset, duration)
+        return timeline.times[window], timeline.pitches[window]
     
-def get_pitch_onset(audio_path):
-    y, sr = librosa.load(audio_path)
-
-    # Perform onset detection
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr)
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
-    onset_times= onset_times.tolist()
-
-    # Get pitch information using piptrack
-    pitches, _ = librosa.piptrack(y=y, sr=sr)
-
-    # Find the closest pitch values to the detected onset times
-    pitch_at_onsets = []
-    for onset_time in onset_times:
-        frame_idx = librosa.time_to_frames(onset_time, sr=sr)
-        closest_pitch = pitches[:, frame_idx].max()
-        pitch_at_onsets.append(closest_pitch)
-
-    # Create a dictionary of onsets and corresponding pitch values
-    onset_pitch_dict = {onset_time: pitch for onset_time, pitch in zip(onset_times, pitch_at_onsets)}
-
-    return onset_pitch_dict
-
-def get_pitch_beat(audio_path):
-    y, sr = librosa.load(audio_path)
-
-    # Perform beat tracking
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beats, sr=sr)
-    beat_times = beat_times.tolist()
-
-    # Get pitch information using piptrack
-    pitches, _ = librosa.piptrack(y=y, sr=sr)
-
-    # Find the closest pitch values to the detected onset times
-    pitch_at_beats = []
-    for onset_time in beat_times:
-        frame_idx = librosa.time_to_frames(onset_time, sr=sr)
-        closest_pitch = pitches[:, frame_idx].max()
-        pitch_at_beats.append(closest_pitch)
-
-    # Create a dictionary of onsets and corresponding pitch values
-    beat_pitch_dict = {onset_time: pitch for onset_time, pitch in zip(beat_times, pitch_at_beats)}
-
-    return beat_pitch_dict
-
-def get_pitch_all(audio_path):
-    y, sr = librosa.load(audio_path)
-
-    # Perform beat tracking
-    tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
-    beat_times = librosa.frames_to_time(beats, sr=sr)
-    beat_times = beat_times.tolist()
-
-    # Perform onset detection
-    onset_frames = librosa.onset.onset_detect(y=y, sr=sr)
-    onset_times = librosa.frames_to_time(onset_frames, sr=sr)
-    onset_times = onset_times.tolist()
-
-    # Get pitch information using piptrack
-    pitches, _ = librosa.piptrack(y=y, sr=sr)
-
-    # Find the closest pitch values to the beat times
-    pitch_at_beats = []
-    for beat_time in beat_times:
-        frame_idx = librosa.time_to_frames(beat_time, sr=sr)
-        closest_pitch = pitches[:, frame_idx].max()
-        pitch_at_beats.append(closest_pitch)
-
-    # Find the closest pitch values to the onset times
-    pitch_at_onsets = []
-    for onset_time in onset_times:
-        frame_idx = librosa.time_to_frames(onset_time, sr=sr)
-        closest_pitch = pitches[:, frame_idx].max()
-        pitch_at_onsets.append(closest_pitch)
-
-    # Create dictionaries with both beat times and onset times as keys and corresponding pitch values
-    beat_time_pitch_dict = {beat_time: pitch for beat_time, pitch in zip(beat_times, pitch_at_beats)}
-    onset_time_pitch_dict = {onset_time: pitch for onset_time, pitch in zip(onset_times, pitch_at_onsets)}
-
-    # Merge both dictionaries and sort by keys
-    time_pitch_dict = {**beat_time_pitch_dict, **onset_time_pitch_dict}
-    sorted_time_pitch_dict = {k: v for k, v in sorted(time_pitch_dict.items(), key=lambda item: item[0])}
-
-    return sorted_time_pitch_dict
-
-'''
-path = 'audio/field.wav'
-# audio_data, sampling_rate = librosa.load(path)
-data = get_pitch_beat(path)
-values_array = np.array(list(data.values()))
-
-# Find the maximum and minimum values
-max_value = np.max(values_array)
-min_value = np.min(values_array)
-
-print(f"max: {max_value} min: {min_value}")
-print(data)
-
-plt.plot(data.keys(), data.values(), marker='o')
-plt.xlabel('Time')
-plt.ylabel('Pitch')
-plt.title('Time vs Pitch in Song')
-plt.show()
-'''
-
-print(f"Time it took: {time.time() - t1}")
\ No newline at end of file
+    analysis = get_analysis(audio_path, profile, offset, duration)
+    return select_events(*analysis.events, difficulty)
+
+# get_song_data over several (start, end) sections of a song, each decoded and
+# analyzed on its own. Overlapping sections are merged first.
+def get_section_data(audio_path: str, difficulty: str, sections, profile: str = DEFAULT_PROFILE):
+    merged = []
+    for start, end in sorted(sections):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+
+    parts = [get_song_data(audio_path, difficulty, profile, start, end - start) for start, end in merged]
+    if not parts:
+        return np.zeros(0), np.zeros(0, dtype=np.float32)
+    return np.concatenate([t for t, _ in parts]), np.concatenate([p for _, p in parts])
+    
+# Returns parallel arrays (times, pitches) for the given analysis frames
+def get_pitch_at_frames(source, frames, profile=DEFAULT_PROFILE):
+    analysis = get_analysis(source, profile)
+    frames = np.asarray(frames, dtype=np.intp)
+    return analysis.frames_to_time(frames), analysis.pitch_at_frames(frames)
+
+def get_pitch_onset(source, profile=DEFAULT_PROFILE):
+    analysis = get_analysis(source, profile)
+    return get_pitch_at_frames(analysis, analysis.onset_frames)
+
+def get_pitch_beat(source, profile=DEFAULT_PROFILE):
+    analysis = get_analysis(source, profile)
+    return get_pitch_at_frames(analysis, analysis.beat_frames)
+
+def get_pitch_all(source, profile=DEFAULT_PROFILE):
+    analysis = get_analysis(source, profile)
+
+    # Beats and onsets that land on the same frame become one event, sorted by time
+    frames = np.union1d(analysis.beat_frames, analysis.onset_frames)
+    return get_pitch_at_frames(analysis, frames)
+
+# Parameters for streaming analysis. The stream decodes at the file's native sample
+# rate, so there is no "sr" here; block_length is in frames, context and lookahead
+# in seconds.
+STREAM_PARAMS = {"n_fft": 2048, "hop_length": 512, "block_length": 256, "context": 10.0, "lookahead": 2.0}
+
+# Streamed beats whose onset strength nearby is below this fraction of the
+# loudest onset so far are taken to be in silence (see StreamingAnalysis.emit)
+SILENT_BEAT = 0.05
+
+# Incremental onset/beat detection over overlapping blocks from librosa.stream.
+# Only the last `context` seconds of onset envelope and frame pitch are kept, so
+# memory stays flat no matter how long the file is. Events are emitted once
+# `lookahead` seconds of audio past them have been analyzed, which is enough for
+# peak picking and for the beat tracker to settle.
+class StreamingAnalysis:
+    def __init__(self, audio_path, n_fft=2048, hop_length=512, block_length=256, context=10.0, lookahead=2.0):
+        self.audio_path = audio_path
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.block_length = block_length
+        self.sr = librosa.get_samplerate(audio_path)
+
+        frames_per_second = self.sr / hop_length
+        # The envelope at an uncentered frame reflects the end of its window; events
+        # are shifted by this many frames so times and pitch windows line up with
+        # the centered full-song analysis (onset_strength applies the same lag there)
+        self.lag = n_fft // (2 * hop_length)
+        self.context = int(context * frames_per_second)
+        self.lookahead = int(lookahead * frames_per_second)
+
+        # Same peak picking windows onset_detect uses by default
+        self.peak_params = {
+            "pre_max": int(0.03 * frames_per_second),
+            "post_max": int(0.00 * frames_per_second) + 1,
+            "pre_avg": int(0.10 * frames_per_second),
+            "post_avg": int(0.10 * frames_per_second) + 1,
+            "delta": 0.07,
+            "wait": int(0.03 * frames_per_second),
+        }
+
+        self.envelope = np.zeros(0, dtype=np.float32)
+        self.frame_pitch = np.zeros(0, dtype=np.float32)
+        self.offset = 0 # absolute frame index of envelope[0]
+        self.committed = 0 # absolute frame index up to which events have been emitted
+        self.envelope_max = 1e-6
+        self.last_onset = -self.peak_params["wait"] - 1
+        self.last_beat = -self.context
+        self.prev_mel = None
+
+    # Yields (beat_frames, onset_frames, pitches_at_beats, pitches_at_onsets) as the song is read
+    def blocks(self):
+        stream = librosa.stream(self.audio_path, block_length=self.block_length, frame_length=self.n_fft,
+                                hop_length=self.hop_length, fill_value=0)
+        for block in stream:
+            self.add_block(block)
+            end = self.offset + len(self.envelope)
+            if end - self.lookahead > self.committed:
+                yield self.emit(end - self.lookahead)
+                self.trim()
+        yield self.emit(self.offset + len(self.envelope))
+
+    @perf.timed("analysis.stream_block")
+    def add_block(self, block):
+        # center=False keeps frames of consecutive blocks contiguous
+        spectrum = np.abs(librosa.stft(block, n_fft=self.n_fft, hop_length=self.hop_length, center=False))
+        mel = librosa.power_to_db(librosa.feature.melspectrogram(S=spectrum ** 2, sr=self.sr))
+
+        # Prepend the previous block's last frame so the envelope difference spans the seam
+        prev_mel = mel[:, :1] if self.prev_mel is None else self.prev_mel
+        envelope = librosa.onset.onset_strength(S=np.hstack([prev_mel, mel]), sr=self.sr, center=False)[1:]
+        self.prev_mel = mel[:, -1:]
+
+        pitches, _ = librosa.piptrack(S=spectrum, sr=self.sr, n_fft=self.n_fft, hop_length=self.hop_length)
+
+        self.envelope = np.concatenate([self.envelope, envelope])
+        self.frame_pitch = np.concatenate([self.frame_pitch, pitches.max(axis=0)])
+        self.envelope_max = max(self.envelope_max, float(envelope.max(initial=0)))
+
+    @perf.timed("analysis.stream_emit")
+    def emit(self, until):
+        start = self.committed
+
+        peaks = librosa.util.peak_pick(self.envelope / self.envelope_max, **self.peak_params) + self.offset
+        onsets = peaks[(peaks >= start) & (peaks < until) & (peaks > self.last_onset + self.peak_params["wait"])]
+
+        tempo, beats = librosa.beat.beat_track(onset_envelope=self.envelope, sr=self.sr,
+                                               hop_length=self.hop_length, trim=False)
+        # trim=False since the window's edges aren't the song's, but then the tracker
+        # also keeps beats in the silence before and after the music, which the
+        # full-song analysis trims. Beats with next to no onset strength around
+        # them are dropped instead.
+        radius = self.peak_params["pre_avg"]
+        strength = np.lib.stride_tricks.sliding_window_view(np.pad(self.envelope, radius), 2 * radius + 1)[beats]
+        beats = beats[strength.max(axis=1, initial=0) >= SILENT_BEAT * self.envelope_max]
+        beats = beats + self.offset
+        beats = beats[(beats >= start) & (beats < until)]
+        # Re-tracking overlapping windows can put a beat right after one already emitted
+        min_gap = 0.5 * 60.0 / max(float(np.atleast_1d(tempo)[0]), 1.0) * self.sr / self.hop_length
+        if len(beats) > 0 and beats[0] - self.last_beat < min_gap:
+            beats = beats[1:]
+
+        if len(onsets) > 0:
+            self.last_onset = onsets[-1]
+        if len(beats) > 0:
+            self.last_beat = beats[-1]
+        self.committed = until
+
+        beats = beats + self.lag
+        onsets = onsets + self.lag
+        return (beats, onsets,
+                self.frame_pitch[np.minimum(beats - self.offset, len(self.frame_pitch) - 1)],
+                self.frame_pitch[np.minimum(onsets - self.offset, len(self.frame_pitch) - 1)])
+
+    def trim(self):
+        drop = max(0, self.committed - self.context - self.offset)
+        self.envelope = self.envelope[drop:]
+        self.frame_pitch = self.frame_pitch[drop:]
+        self.offset += drop
+
+    def frames_to_time(self, frames):
+        # Uncentered frames: a frame's time is the middle of its window
+        return librosa.frames_to_time(frames, sr=self.sr, hop_length=self.hop_length, n_fft=self.n_fft)
+
+# Streaming counterpart of get_song_data. Yields (times, pitches) chunks in time
+# order while the file is still being read.
+# Density thinning and spacing are applied per chunk, so spacing isn't enforced
+# across the seam between two chunks.
+def stream_song_data(audio_path: str, difficulty: str, **params):
+    analysis = StreamingAnalysis(audio_path, **{**STREAM_PARAMS, **params})
+
+    for beats, onsets, beat_pitches, onset_pitches in analysis.blocks():
+        frames, unique = np.unique(np.concatenate([beats, onsets]), return_index=True)
+        pitches = np.concatenate([beat_pitches, onset_pitches])[unique]
+        times, pitches = select_events(analysis.frames_to_time(frames), pitches, np.isin(frames, beats),
+                                       np.isin(frames, onsets), difficulty)
+        if len(times) > 0:
+            yield times, pitches
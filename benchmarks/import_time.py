@@ -0,0 +1,44 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Measures how long the game's own modules take to import in a fresh interpreter,
+# which is what stands between launching main.py and the window appearing.
+# "eager" is what audio_handling used to pull in at import time (librosa and
+# matplotlib.pyplot); "game" is what main.py imports now.
+#
+#   python benchmarks/import_time.py --runs 10
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CASES = {
+    "baseline": "pass",
+    "eager": "import librosa, matplotlib.pyplot, numpy",
+    "game": "import audio_handling, chart, chart_cache, chart_loader",
+    "game+analysis": "import audio_handling; audio_handling.librosa.load",
+}
+
+def time_import(statement, runs):
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=ROOT, check=True)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark for the game modules.")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    results = {name: time_import(statement, args.runs) for name, statement in CASES.items()}
+    baseline = statistics.median(results["baseline"])
+    for name, samples in results.items():
+        median = statistics.median(samples)
+        print(f"{name:>14}: {median * 1000:8.1f} ms median ({(median - baseline) * 1000:8.1f} ms over interpreter startup)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from audio_handling import DEFAULT_PROFILE, PROFILES, SongAnalysis, get_pitch_at_frames
+from chart import quantize_lanes
+
+# Speed/accuracy trade-off of each analysis profile. Every song is analyzed with
+# every profile, timing each stage; events are then matched against the default
+# profile's within a tolerance to get F-measures for beats and onsets, and the
+# lanes of matched onsets are compared to see how often the chart would differ.
+#
+#   python benchmarks/profiles.py audio/field.wav other.mp3
+
+STAGES = ("load", "spectrum", "onset_envelope", "beat_frames", "onset_frames", "event_pitch")
+
+def analyze(path, profile):
+    timings = {}
+    start = time.perf_counter()
+    analysis = SongAnalysis(path, **PROFILES[profile])
+    timings["load"] = time.perf_counter() - start
+    for stage in STAGES[1:-1]:
+        stage_start = time.perf_counter()
+        getattr(analysis, stage)
+        timings[stage] = time.perf_counter() - stage_start
+
+    stage_start = time.perf_counter()
+    analysis.pitch_at_frames(np.union1d(analysis.beat_frames, analysis.onset_frames))
+    timings["event_pitch"] = time.perf_counter() - stage_start
+    timings["total"] = time.perf_counter() - start
+    return analysis, timings
+
+# Greedy one-to-one matching of estimated to reference event times
+def match_events(reference, estimate, tolerance):
+    matches = []
+    j = 0
+    for i, t in enumerate(reference):
+        while j < len(estimate) and estimate[j] < t - tolerance:
+            j += 1
+        if j < len(estimate) and abs(estimate[j] - t) <= tolerance:
+            matches.append((i, j))
+            j += 1
+    return matches
+
+def f_measure(n_matches, n_reference, n_estimate):
+    if n_reference == 0 and n_estimate == 0:
+        return 1.0
+    if n_matches == 0:
+        return 0.0
+    precision = n_matches / n_estimate
+    recall = n_matches / n_reference
+    return 2 * precision * recall / (precision + recall)
+
+def compare(reference, analysis, tolerance):
+    scores = {}
+    for name in ("beat_frames", "onset_frames"):
+        ref_times, ref_pitches = get_pitch_at_frames(reference, getattr(reference, name))
+        est_times, est_pitches = get_pitch_at_frames(analysis, getattr(analysis, name))
+        matches = match_events(ref_times, est_times, tolerance)
+        scores[name.split("_")[0] + "_f"] = f_measure(len(matches), len(ref_times), len(est_times))
+
+        if name == "onset_frames" and matches:
+            ref_idx, est_idx = np.array(matches).T
+            same = quantize_lanes(ref_pitches)[ref_idx] == quantize_lanes(est_pitches)[est_idx]
+            scores["lane_agreement"] = float(same.mean())
+    return scores
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare analysis profiles on the same songs.")
+    parser.add_argument("songs", nargs="+")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="event match tolerance in seconds")
+    args = parser.parse_args()
+
+    totals = {profile: {} for profile in PROFILES}
+    for path in args.songs:
+        reference, reference_timings = analyze(path, DEFAULT_PROFILE)
+        duration = len(reference.y) / reference.sr
+        print(f"\n{path} ({duration:.1f}s)")
+        print(f"{'profile':>10} " + " ".join(f"{stage[:12]:>12}" for stage in STAGES) +
+              f" {'total':>8} {'speedup':>8} {'beat_f':>7} {'onset_f':>7} {'lanes':>6}")
+
+        for profile in PROFILES:
+            if profile == DEFAULT_PROFILE:
+                analysis, timings = reference, reference_timings
+            else:
+                analysis, timings = analyze(path, profile)
+            scores = compare(reference, analysis, args.tolerance)
+            speedup = reference_timings["total"] / timings["total"]
+
+            print(f"{profile:>10} " + " ".join(f"{timings[stage]:12.3f}" for stage in STAGES) +
+                  f" {timings['total']:8.3f} {speedup:7.2f}x {scores['beat_f']:7.3f} {scores['onset_f']:7.3f}"
+                  f" {scores.get('lane_agreement', float('nan')):6.3f}")
+
+            for key, value in {"speedup": speedup, **scores}.items():
+                totals[profile].setdefault(key, []).append(value)
+
+    if len(args.songs) > 1:
+        print("\nmean over all songs")
+        for profile, values in totals.items():
+            print(f"{profile:>10} " + " ".join(f"{key} {np.nanmean(v):.3f}" for key, v in values.items()))
+
+if __name__ == "__main__":
+    main()
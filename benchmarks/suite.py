@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import wave
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from audio_handling import DEFAULT_PROFILE, PROFILES, SongAnalysis, is_vocal, librosa
+from chart import DIFFICULTIES, NoteTimeline, select_events
+
+# Benchmark suite for song analysis and the game loop, runnable offline. Songs are
+# synthetic (click tracks, chirps and noise at a few lengths) and written to a
+# temporary directory; each analysis stage is timed on its own. The game loop runs
+# MainWidget's tile code against a stubbed Kivy, so it needs no window and only
+# measures the game's own work, at several numbers of tiles on screen. Results are
+# written as JSON; pass an earlier result file to --compare to see what changed.
+#
+#   python benchmarks/suite.py -o before.json
+#   python benchmarks/suite.py -o after.json --compare before.json
+
+SR = 22050
+FIXTURES = ("click", "chirp", "noise")
+LENGTHS = (10, 30, 120)
+STAGES = ("load", "stft", "onset", "beat", "event_pitch", "event_lookup", "is_vocal")
+TILE_COUNTS = (8, 32, 128, 512)
+
+# Synthetic songs
+
+# 120 bpm clicks, each a short decaying tone cycling through four pitches so the
+# chart uses every lane
+def click_track(seconds, sr=SR, bpm=120):
+    y = np.zeros(int(seconds * sr), dtype=np.float32)
+    t = np.arange(int(0.05 * sr)) / sr
+    for i, start in enumerate(np.arange(0, seconds, 60 / bpm)):
+        freq = (440, 660, 880, 1320)[i % 4]
+        burst = np.sin(2 * np.pi * freq * t) * np.exp(-t * 60)
+        begin = int(start * sr)
+        end = min(begin + len(burst), len(y))
+        y[begin:end] += burst[:end - begin]
+    return y
+
+# Exponential sweep from 100 Hz to 4 kHz over the whole song
+def chirp(seconds, sr=SR):
+    return librosa.chirp(fmin=100, fmax=4000, sr=sr, duration=seconds).astype(np.float32)
+
+def noise(seconds, sr=SR):
+    return np.random.default_rng(0).normal(0, 0.1, int(seconds * sr)).astype(np.float32)
+
+SIGNALS = {"click": click_track, "chirp": chirp, "noise": noise}
+
+def write_wav(path, y, sr=SR):
+    samples = (np.clip(y, -1, 1) * 32767).astype(np.int16)
+    with wave.open(path, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(sr)
+        f.writeframes(samples.tobytes())
+
+# Analysis
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def bench_analysis(path, profile):
+    timings = {}
+    analysis, timings["load"] = timed(lambda: SongAnalysis(path, **PROFILES[profile]))
+    _, timings["stft"] = timed(lambda: analysis.spectrum)
+    _, timings["onset"] = timed(lambda: (analysis.onset_envelope, analysis.onset_frames))
+    _, timings["beat"] = timed(lambda: analysis.beat_frames)
+    # Building the events estimates pitch at the event frames only, with the
+    # profile's estimator, which is all the pitch work get_song_data does
+    _, timings["event_pitch"] = timed(lambda: analysis.events)
+    _, timings["event_lookup"] = timed(lambda: [select_events(*analysis.events, difficulty)
+                                               for difficulty in DIFFICULTIES])
+    _, timings["is_vocal"] = timed(lambda: is_vocal(analysis.y, analysis.sr, profile))
+    timings["total"] = sum(timings.values())
+    return timings
+
+# Game loop
+
+# Just enough of Kivy for main.py to import and for MainWidget's drawing code to run:
+# graphics instructions only store the attributes set on them, and everything that
+# would touch a window, the clock or audio does nothing.
+class _Instruction:
+    def __init__(self, *args, **kwargs):
+        self.__dict__.update(kwargs)
+
+class _Canvas(_Instruction):
+    def add(self, instruction):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+class _Noop:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+class _Widget:
+    def __init__(self, **kwargs):
+        self.canvas = _Canvas()
+        self.width = kwargs.get("width", 100)
+        self.height = kwargs.get("height", 100)
+
+    def bind(self, **kwargs):
+        pass
+
+class _StubModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if name.endswith("Property"):
+            return lambda default=None, **kwargs: default
+        return _Instruction
+
+def stub_kivy():
+    names = ("kivy", "kivy.config", "kivy.core", "kivy.core.window", "kivy.core.audio", "kivy.app",
+             "kivy.uix", "kivy.uix.relativelayout", "kivy.uix.widget", "kivy.uix.label", "kivy.properties",
+             "kivy.clock", "kivy.graphics", "kivy.graphics.context_instructions",
+             "kivy.graphics.vertex_instructions", "kivy.lang", "kivy.lang.builder", "kivy.metrics")
+    kivy = {name: _StubModule(name) for name in names}
+    sys.modules.update(kivy)
+    kivy["kivy"].platform = "headless"
+    kivy["kivy.config"].Config = _Noop()
+    kivy["kivy.core.window"].Window = _Noop()
+    kivy["kivy.core.audio"].SoundLoader = _Noop()
+    kivy["kivy.lang.builder"].Builder = _Noop()
+    kivy["kivy.properties"].Clock = kivy["kivy.clock"].Clock = _Noop()
+    kivy["kivy.clock"].mainthread = lambda func: func
+    kivy["kivy.graphics"].InstructionGroup = _Canvas
+    kivy["kivy.app"].App = object
+    kivy["kivy.uix.relativelayout"].RelativeLayout = kivy["kivy.uix.widget"].Widget = _Widget
+    kivy["kivy.metrics"].dp = lambda value: value
+
+# A MainWidget with its canvas set up but no keyboard, clock, song or chart loader
+def headless_widget(width, height):
+    stub_kivy()
+    from main import MainWidget
+
+    widget = MainWidget.__new__(MainWidget)
+    _Widget.__init__(widget, width=width, height=height)
+    widget.perspective_point_x = width / 2
+    widget.perspective_point_y = height * 0.75
+    widget.lines, widget.tiles, widget.tile_colors = [], [], []
+    widget.init_background()
+    widget.init_buttons()
+    widget.init_tiles()
+    widget.init_lines()
+    widget.update_geometry()
+    return widget
+
+# Evenly spaced notes cycling through the lanes, dense enough that about `tiles`
+# tiles are falling at once
+def steady_timeline(tiles, seconds, travel_time):
+    interval = travel_time / tiles
+    times = np.arange(travel_time, seconds + 2 * travel_time, interval)
+    lanes = np.arange(len(times)) % 4
+    return NoteTimeline(times, lanes, np.ones(len(times)), np.zeros(len(times)))
+
+def bench_game_loop(tiles, seconds, width=900, height=400, fps=60):
+    widget = headless_widget(width, height)
+    widget.state.add_timeline(steady_timeline(tiles, seconds, widget.TRAVEL_TIME))
+
+    place, update, active = [], [], []
+    # Notes are never hit, so every one scrolls off the bottom and counts as a miss
+    for frame in range(int((seconds + widget.TRAVEL_TIME) * fps)):
+        now = frame / fps
+        _, place_time = timed(lambda: widget.place_tiles(now))
+        _, update_time = timed(lambda: widget.update_tiles(now))
+        # The first travel time fills the screen; only steady state is measured
+        if now >= widget.TRAVEL_TIME:
+            place.append(place_time)
+            update.append(update_time)
+            active.append(len(widget.state.tile_pool))
+
+    frame = np.add(place, update) * 1000
+    x = np.random.default_rng(0).uniform(0, width, (tiles, 4))
+    y = np.random.default_rng(1).uniform(0, height, (tiles, 4))
+    repeats = 200
+    _, transform_time = timed(lambda: [widget.transform_array(x, y) for _ in range(repeats)])
+    _, geometry_time = timed(lambda: [widget.update_geometry() for _ in range(repeats)])
+    return {
+        "tiles": tiles,
+        "active_mean": float(np.mean(active)),
+        "frames": len(frame),
+        "place_tiles_ms": float(np.mean(place) * 1000),
+        "update_tiles_ms": float(np.mean(update) * 1000),
+        "frame_ms": float(frame.mean()),
+        "frame_p99_ms": float(np.percentile(frame, 99)),
+        "transform_array_ms": transform_time / repeats * 1000,
+        "update_geometry_ms": geometry_time / repeats * 1000,
+    }
+
+# Results
+
+def metadata(profile):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "librosa": librosa.__version__,
+        "machine": platform.platform(),
+        "profile": profile,
+    }
+
+# {"analysis/click/30s/stft": seconds, "game_loop/128/frame_ms": ms, ...}
+def flatten(results):
+    flat = {}
+    for entry in results.get("analysis", []):
+        for stage, seconds in entry["timings"].items():
+            flat[f"analysis/{entry['fixture']}/{entry['seconds']}s/{stage}"] = seconds
+    for entry in results.get("game_loop", []):
+        for key, value in entry.items():
+            if key.endswith("_ms"):
+                flat[f"game_loop/{entry['tiles']}/{key}"] = value
+    return flat
+
+def compare(baseline, results):
+    old, new = flatten(baseline), flatten(results)
+    print(f"compared with {baseline['meta'].get('commit')} ({baseline['meta'].get('created')})", file=sys.stderr)
+    for key in new:
+        if key in old and old[key] > 0:
+            ratio = new[key] / old[key]
+            print(f"{key:>44}: {old[key]:10.4f} -> {new[key]:10.4f} {ratio:6.2f}x", file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for song analysis and the game loop.")
+    parser.add_argument("-o", "--output", help="write results here instead of stdout")
+    parser.add_argument("--compare", help="earlier result file to compare against")
+    parser.add_argument("-p", "--profile", choices=PROFILES, default=DEFAULT_PROFILE)
+    parser.add_argument("--fixtures", nargs="+", choices=FIXTURES, default=FIXTURES)
+    parser.add_argument("--lengths", nargs="+", type=float, default=LENGTHS, help="song lengths in seconds")
+    parser.add_argument("--tiles", nargs="+", type=int, default=TILE_COUNTS, help="tiles on screen")
+    parser.add_argument("--frames-seconds", type=float, default=10.0, help="steady-state game time measured per tile count")
+    parser.add_argument("--skip-analysis", action="store_true")
+    parser.add_argument("--skip-game", action="store_true")
+    args = parser.parse_args()
+
+    results = {"meta": metadata(args.profile), "analysis": [], "game_loop": []}
+
+    if not args.skip_analysis:
+        with tempfile.TemporaryDirectory() as tmp:
+            # The first analysis also pays for importing librosa and compiling its
+            # numba functions, so run one that isn't recorded
+            warmup = os.path.join(tmp, "warmup.wav")
+            write_wav(warmup, click_track(5))
+            bench_analysis(warmup, args.profile)
+
+            for fixture in args.fixtures:
+                for seconds in args.lengths:
+                    path = os.path.join(tmp, f"{fixture}_{seconds:g}.wav")
+                    write_wav(path, SIGNALS[fixture](seconds))
+                    timings = bench_analysis(path, args.profile)
+                    results["analysis"].append({"fixture": fixture, "seconds": seconds, "timings": timings})
+                    print(f"{fixture:>6} {seconds:6g}s " + " ".join(f"{stage} {timings[stage]:.3f}"
+                                                              for stage in STAGES), file=sys.stderr)
+
+    if not args.skip_game:
+        for tiles in args.tiles:
+            entry = bench_game_loop(tiles, args.frames_seconds)
+            results["game_loop"].append(entry)
+            print(f"{tiles:>6} tiles ({entry['active_mean']:.0f} active): {entry['frame_ms']:.3f} ms/frame, "
+                  f"p99 {entry['frame_p99_ms']:.3f} ms", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import zlib
+
+import numpy as np
+
+NUM_LANES = 4
+CHORD_WINDOW = 0.15 # seconds between notes that get merged into one chord
+MAX_CHORD = 3
+SPAWN_WINDOW = 0.08 # how early (in seconds) a note may spawn before its time
+
+# How each difficulty is charted from the song's beats and onsets:
+#   events       which detected events are candidates ("beats", "onsets" or "all")
+#   density      chance an onset that isn't also a beat survives thinning
+#   min_spacing  seconds required between consecutive notes (0 = no limit)
+#   max_chord    largest chord that close notes are merged into
+DIFFICULTY_SETTINGS = {
+    "easy": {"events": "beats", "density": 1.0, "min_spacing": 0.0, "max_chord": MAX_CHORD},
+    "medium": {"events": "onsets", "density": 1.0, "min_spacing": 0.0, "max_chord": MAX_CHORD},
+    "hard": {"events": "all", "density": 0.6, "min_spacing": 0.25, "max_chord": 2},
+    "expert": {"events": "all", "density": 0.85, "min_spacing": 0.12, "max_chord": MAX_CHORD},
+    "impossible": {"events": "all", "density": 1.0, "min_spacing": 0.0, "max_chord": MAX_CHORD},
+}
+DIFFICULTIES = tuple(DIFFICULTY_SETTINGS)
+
+# Every difficulty gets its own fixed seed, so a chart is the same every time
+def difficulty_seed(difficulty):
+    return zlib.crc32(difficulty.encode())
+
+# Seed for the notes of a chart, or of a streamed chunk of one, whose first event
+# is at `start` seconds. Event thinning and chord lanes are both seeded from here,
+# so a chart built in one piece is the same in the game (without stream_chart) as
+# in an exported chart file. A streamed chart still differs: each chunk is thinned
+# on its own and its lanes only use the pitch range seen so far.
+def chunk_seed(difficulty, start):
+    return difficulty_seed(difficulty) + int(round(start * 1000))
+
+# Precomputed, immutable note chart. All arrays are parallel with one entry per
+# tile, sorted by time. Notes of the same chord share the chord's spawn time and
+# chord size; the first note of a chord takes the pitch lane, the rest take
+# distinct random lanes.
+class NoteTimeline:
+    def __init__(self, times, lanes, chord_sizes, pitches):
+        self.times = np.asarray(times, dtype=np.float64)
+        self.lanes = np.asarray(lanes, dtype=np.int8)
+        self.chord_sizes = np.asarray(chord_sizes, dtype=np.int8)
+        self.pitches = np.asarray(pitches, dtype=np.float32)
+        for array in (self.times, self.lanes, self.chord_sizes, self.pitches):
+            array.setflags(write=False)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __getitem__(self, index):
+        return NoteTimeline(self.times[index], self.lanes[index], self.chord_sizes[index], self.pitches[index])
+
+    @staticmethod
+    def concatenate(timelines):
+        return NoteTimeline(np.concatenate([t.times for t in timelines]),
+                            np.concatenate([t.lanes for t in timelines]),
+                            np.concatenate([t.chord_sizes for t in timelines]),
+                            np.concatenate([t.pitches for t in timelines]))
+
+# Mask of the times inside [offset, offset + duration); duration None means to the end
+def in_window(times, offset=0.0, duration=None):
+    mask = np.asarray(times) >= offset
+    if duration is not None:
+        mask &= np.asarray(times) < offset + duration
+    return mask
+
+# Buckets pitches into lanes by where they fall between the lowest and highest pitch
+def quantize_lanes(pitches, pitch_range=None):
+    pitches = np.asarray(pitches, dtype=np.float64)
+    if len(pitches) == 0:
+        return np.zeros(0, dtype=np.int8)
+
+    lo, hi = pitch_range if pitch_range is not None else (pitches.min(), pitches.max())
+    if hi <= lo:
+        return np.zeros(len(pitches), dtype=np.int8)
+    lanes = ((pitches - lo) / (hi - lo) * NUM_LANES).astype(np.int64)
+    return np.clip(lanes, 0, NUM_LANES - 1).astype(np.int8)
+
+# Picks a difficulty's notes from the song's events. times/pitches are every
+# detected event, is_beat/is_onset say what detected it. Non-beat onsets are
+# thinned at random to the difficulty's density, then notes closer than its
+# min_spacing are dropped. Returns the kept (times, pitches), sorted by time.
+def select_events(times, pitches, is_beat, is_onset, difficulty, seed=None):
+    settings = DIFFICULTY_SETTINGS[difficulty]
+    times = np.asarray(times, dtype=np.float64)
+    pitches = np.asarray(pitches, dtype=np.float32)
+    is_beat = np.asarray(is_beat, dtype=bool)
+    is_onset = np.asarray(is_onset, dtype=bool)
+    if seed is None:
+        seed = chunk_seed(difficulty, times.min() if len(times) else 0.0)
+
+    match settings["events"]:
+        case "beats":
+            keep = is_beat
+        case "onsets":
+            keep = is_onset
+        case _:
+            keep = is_beat | is_onset
+
+    if settings["density"] < 1.0:
+        rng = np.random.default_rng(seed)
+        keep &= is_beat | (rng.random(len(times)) < settings["density"])
+
+    order = np.flatnonzero(keep)
+    order = order[np.argsort(times[order], kind="stable")]
+    times, pitches, is_beat = times[order], pitches[order], is_beat[order]
+
+    if settings["min_spacing"] > 0 and len(times) > 1:
+        keep = enforce_spacing(times, is_beat, settings["min_spacing"])
+        times, pitches = times[keep], pitches[keep]
+    return times, pitches
+
+# Indices of notes to keep so that no two are closer than `spacing`. First every
+# spacing-wide slot of the song keeps one note, preferring beats, which leaves at
+# most pairs that straddle a slot edge; those are removed in a few array passes
+# that each drop the second note of every too-close pair whose first note stays.
+def enforce_spacing(times, is_beat, spacing):
+    slots = np.floor(times / spacing).astype(np.int64)
+    # Sort by slot, beats first, then time, and keep the first note of each slot
+    order = np.lexsort((times, ~is_beat, slots))
+    first = np.unique(slots[order], return_index=True)[1]
+    keep = np.sort(order[first])
+
+    while len(keep) > 1:
+        close = np.diff(times[keep]) < spacing
+        if not close.any():
+            break
+        # Drop note i + 1 when (i, i + 1) is too close, unless note i is itself dropped
+        drop = close & ~np.concatenate([[False], close[:-1]])
+        keep = keep[np.concatenate([[True], ~drop])]
+    return keep
+
+# Turns (time, pitch) events into a timeline. Up to max_chord consecutive events
+# less than CHORD_WINDOW apart are merged into a chord spawned at the first one;
+# the first note of a chord takes its pitch lane and the rest take distinct lanes
+# picked with the seeded generator.
+def build_timeline(times, pitches, pitch_range=None, seed=0, max_chord=MAX_CHORD):
+    times = np.asarray(times, dtype=np.float64)
+    pitches = np.asarray(pitches, dtype=np.float32)
+    order = np.argsort(times, kind="stable")
+    times, pitches = times[order], pitches[order]
+    n = len(times)
+    if n == 0:
+        return NoteTimeline(times, np.zeros(0), np.zeros(0), pitches)
+
+    # Runs of events linked by short gaps, split into chords of max_chord from
+    # the start of each run (the same grouping as walking the events greedily)
+    run_start = np.concatenate([[True], np.diff(times) > CHORD_WINDOW])
+    run_first = np.maximum.accumulate(np.where(run_start, np.arange(n), 0))
+    position = (np.arange(n) - run_first) % max_chord
+    chord_start = position == 0
+    chord = np.cumsum(chord_start) - 1
+    heads = np.flatnonzero(chord_start)
+    chord_sizes = np.diff(np.append(heads, n))[chord]
+
+    # Each chord gets a random ordering of the lanes other than its head's
+    head_lanes = quantize_lanes(pitches, pitch_range)[heads].astype(np.int64)
+    rng = np.random.default_rng(seed)
+    others = (head_lanes[:, None] + 1 + np.argsort(rng.random((len(heads), NUM_LANES - 1)), axis=1)) % NUM_LANES
+    lanes = np.where(chord_start, head_lanes[chord],
+                     others[chord, np.maximum(position - 1, 0) % (NUM_LANES - 1)])
+
+    return NoteTimeline(times[heads][chord], lanes, chord_sizes, pitches)
+
+# build_timeline with a difficulty's chord limit and seed
+def generate_chart(times, pitches, difficulty, pitch_range=None, seed=None):
+    if seed is None:
+        seed = chunk_seed(difficulty, np.min(times) if len(times) else 0.0)
+    return build_timeline(times, pitches, pitch_range, seed, DIFFICULTY_SETTINGS[difficulty]["max_chord"])
+
+# Walks a timeline with a cursor. Each call only looks at the notes it returns
+# (plus one), so the per-tick cost doesn't grow with the length of the song.
+class NoteScheduler:
+    def __init__(self, timeline, window=SPAWN_WINDOW):
+        self.timeline = timeline
+        self.window = window
+        self.cursor = 0
+        self._times = timeline.times.tolist()
+
+    def due(self, now):
+        start = self.cursor
+        end = start
+        limit = now + self.window
+        times = self._times
+        while end < len(times) and times[end] <= limit:
+            end += 1
+        self.cursor = end
+        return range(start, end)
+
+    # Appends notes produced later (e.g. by streaming analysis). Notes already
+    # handed out are dropped, so the timeline only holds what is still to come.
+    def extend(self, timeline):
+        self.timeline = NoteTimeline.concatenate([self.timeline[self.cursor:], timeline])
+        self._times = self.timeline.times.tolist()
+        self.cursor = 0
+
+    def finished(self):
+        return self.cursor >= len(self._times)
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from audio_handling import (ANALYSIS_PARAMS, DEFAULT_PROFILE, PROFILES, STREAM_PARAMS, get_analysis, get_song_data,
+                            stream_song_data)
+from chart import DIFFICULTY_SETTINGS, in_window
+
+# Bump when the analysis itself changes in a way ANALYSIS_PARAMS doesn't capture
+CACHE_VERSION = 5
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".beattrack", "charts")
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+# Eviction frees space down to this fraction of the limit, so a full cache isn't
+# rescanned on every store that follows
+EVICT_TO = 0.9
+
+HASH_CHUNK = 1024 * 1024
+
+# Hash of the audio file contents (not its name), so renamed or copied songs hit the same entry
+def file_hash(path):
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# The difficulty's settings are part of the key, so retuning a difficulty
+# invalidates its cached charts
+def cache_key(content_hash, difficulty, params):
+    raw = json.dumps([CACHE_VERSION, content_hash, difficulty, DIFFICULTY_SETTINGS[difficulty], params],
+                     sort_keys=True)
+    return hashlib.blake2b(raw.encode(), digest_size=20).hexdigest()
+
+# Writes `path` by calling write(f) on a uniquely named temporary file next to it and
+# renaming that over `path`. Worker processes share the cache directory, so a fixed
+# temporary name would have them writing into each other's file.
+def replace_file(path, mode, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+# On-disk chart cache. Each entry is an .npz of parallel (time, pitch) arrays. Entries
+# are evicted least-recently-used first once the directory grows past max_bytes; the
+# file mtime is the recency stamp, so a hit just touches the file. Listing the
+# directory gets slow with thousands of entries, so it is only scanned on the first
+# store and whenever the running total of the sizes stored since goes over max_bytes.
+class ChartCache:
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(cache_dir, "hashes.json")
+        self.hashes = None
+        self.total = None # bytes in the cache as of the last scan plus what this cache stored since
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    # Content hash of an audio file, remembered by (size, mtime) so a cache hit doesn't
+    # have to re-read the whole song. Any change to the file changes its stat and rehashes it.
+    def song_hash(self, audio_path):
+        if self.hashes is None:
+            try:
+                with open(self.index_path) as f:
+                    self.hashes = json.load(f)
+            except (OSError, ValueError):
+                self.hashes = {}
+
+        path = os.path.abspath(audio_path)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.hashes.get(path)
+        if entry is not None and entry[:2] == stamp:
+            return entry[2]
+
+        content_hash = file_hash(path)
+        self.hashes[path] = stamp + [content_hash]
+        # The index only saves rehashing, so failing to write it isn't an error. With
+        # several writers the last one wins and the others' new hashes are recomputed.
+        try:
+            replace_file(self.index_path, "w", lambda f: json.dump(self.hashes, f))
+        except OSError:
+            pass
+        return content_hash
+
+    def key_for(self, audio_path, difficulty, params=ANALYSIS_PARAMS):
+        return cache_key(self.song_hash(audio_path), difficulty, params)
+
+    def has(self, key):
+        return os.path.exists(self.entry_path(key))
+
+    def load(self, key):
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                times, pitches = entry["times"], entry["pitches"]
+        except (OSError, KeyError, ValueError):
+            return None
+        os.utime(path)
+        return times, pitches
+
+    def store(self, key, times, pitches):
+        path = self.entry_path(key)
+        replace_file(path, "wb", lambda f: np.savez(
+            f, times=np.asarray(times, dtype=np.float64), pitches=np.asarray(pitches, dtype=np.float32)))
+        if self.total is None:
+            self.evict()
+            return
+        # Other processes' stores aren't counted, so the directory can run over by
+        # what they stored since this cache last scanned it
+        try:
+            self.total += os.path.getsize(path)
+        except OSError:
+            pass
+        if self.total > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        # Other processes (see prepare_charts.py) may be evicting at the same time,
+        # so entries can vanish between listing and removal
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".npz"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+
+        entries.sort()
+        target = self.max_bytes * EVICT_TO if total > self.max_bytes else self.max_bytes
+        for mtime, size, name in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total = total
+
+# Same as get_song_data, but reads and fills the chart cache. For a window of the
+# song (offset/duration) a whole-song chart cached with the same profile is cut
+# down to the window; without one only the window is analyzed, and that isn't cached.
+def get_song_data_cached(audio_path, difficulty, cache=None, profile=DEFAULT_PROFILE, offset=0.0, duration=None):
+    if cache is None:
+        cache = ChartCache()
+
+    key = cache.key_for(audio_path, difficulty, PROFILES[profile])
+    entry = cache.load(key)
+    if offset > 0 or duration is not None:
+        if entry is None:
+            return get_song_data(audio_path, difficulty, profile, offset, duration)
+        window = in_window(entry[0], offset, duration)
+        return entry[0][window], entry[1][window]
+    if entry is not None:
+        return entry
+
+    song_data = get_song_data(audio_path, difficulty, profile)
+    if song_data is not None:
+        cache.store(key, *song_data)
+    return song_data
+
+# Builds and caches every difficulty of a song that isn't cached yet, sharing one
+# analysis between them. Returns the difficulties built and the song's length in
+# seconds (None if everything was already cached).
+def cache_song(audio_path, difficulties, cache=None, profile=DEFAULT_PROFILE):
+    if cache is None:
+        cache = ChartCache()
+
+    keys = {difficulty: cache.key_for(audio_path, difficulty, PROFILES[profile]) for difficulty in difficulties}
+    missing = [difficulty for difficulty in difficulties if not cache.has(keys[difficulty])]
+    if not missing:
+        return [], None
+
+    analysis = get_analysis(audio_path, profile)
+    built = []
+    for difficulty in missing:
+        song_data = get_song_data(analysis, difficulty)
+        if song_data is not None:
+            cache.store(keys[difficulty], *song_data)
+            built.append(difficulty)
+    return built, len(analysis.y) / analysis.sr
+
+# Streaming counterpart of get_song_data_cached. A cached chart (from either a full
+# or a streamed analysis) is yielded as one chunk; otherwise chunks are yielded as
+# the stream produces them and the whole chart is cached once the stream completes.
+def stream_song_data_cached(audio_path, difficulty, cache=None):
+    if cache is None:
+        cache = ChartCache()
+
+    for params in (ANALYSIS_PARAMS, STREAM_PARAMS):
+        entry = cache.load(cache.key_for(audio_path, difficulty, params))
+        if entry is not None:
+            yield entry
+            return
+
+    key = cache.key_for(audio_path, difficulty, STREAM_PARAMS)
+    chunks = []
+    for times, pitches in stream_song_data(audio_path, difficulty):
+        chunks.append((times, pitches))
+        yield times, pitches
+
+    if chunks:
+        cache.store(key, np.concatenate([t for t, _ in chunks]), np.concatenate([p for _, p in chunks]))
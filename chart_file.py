@@ -0,0 +1,87 @@
+import json
+import os
+import struct
+
+import numpy as np
+
+from chart import NoteTimeline
+
+# Chart file (.btc) layout, little-endian:
+#
+#   8 bytes   magic b"BTCHART\0"
+#   uint32    format version
+#   uint32    length of the JSON header
+#   ...       JSON header: song_hash, difficulty, params, cache_version, count
+#   ...       zero padding to an 8-byte boundary
+#   float64   times[count]
+#   float32   pitches[count]
+#   int8      lanes[count]
+#   int8      chord_sizes[count]
+#
+# The arrays are contiguous and aligned, so they are mapped straight from the file
+# with np.memmap and nothing is parsed or copied when a chart is loaded.
+CHART_MAGIC = b"BTCHART\0"
+CHART_VERSION = 1
+CHART_EXTENSION = ".btc"
+
+PREAMBLE = struct.Struct("<8sII")
+ARRAYS = (("times", np.dtype("<f8")), ("pitches", np.dtype("<f4")), ("lanes", np.dtype("i1")),
+          ("chord_sizes", np.dtype("i1")))
+
+def is_chart_file(path):
+    return isinstance(path, str) and path.lower().endswith(CHART_EXTENSION)
+
+# Where a chart shipped alongside a song is expected: "song.wav" -> "song.easy.btc"
+def chart_path_for(audio_path, difficulty):
+    return f"{os.path.splitext(audio_path)[0]}.{difficulty}{CHART_EXTENSION}"
+
+# cache_version is the chart cache's CACHE_VERSION the chart was generated under,
+# so exported charts can be told apart from ones built by older chart generation
+def save_chart(path, timeline, song_hash, difficulty, params, cache_version):
+    header = json.dumps({
+        "song_hash": song_hash,
+        "difficulty": difficulty,
+        "params": params,
+        "cache_version": cache_version,
+        "count": len(timeline),
+    }).encode()
+    preamble = PREAMBLE.pack(CHART_MAGIC, CHART_VERSION, len(header))
+    padding = -(len(preamble) + len(header)) % 8
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(preamble)
+        f.write(header)
+        f.write(b"\0" * padding)
+        for name, dtype in ARRAYS:
+            f.write(np.ascontiguousarray(getattr(timeline, name), dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+def read_chart_header(path):
+    with open(path, "rb") as f:
+        magic, version, header_length = PREAMBLE.unpack(f.read(PREAMBLE.size))
+        if magic != CHART_MAGIC:
+            raise ValueError(f"{path} is not a chart file")
+        if version != CHART_VERSION:
+            raise ValueError(f"{path} has chart format version {version}, expected {CHART_VERSION}")
+        header = json.loads(f.read(header_length))
+
+    header_end = PREAMBLE.size + header_length
+    header["data_offset"] = header_end + (-header_end % 8)
+    return header
+
+# Returns (header, NoteTimeline) with the timeline's arrays memory-mapped from the file
+def load_chart(path):
+    header = read_chart_header(path)
+    count = header["count"]
+    offset = header["data_offset"]
+
+    arrays = {}
+    for name, dtype in ARRAYS:
+        if count == 0:
+            arrays[name] = np.zeros(0, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(path, dtype=dtype, mode="r", offset=offset, shape=(count,))
+        offset += count * dtype.itemsize
+
+    return header, NoteTimeline(arrays["times"], arrays["lanes"], arrays["chord_sizes"], arrays["pitches"])
@@ -0,0 +1,209 @@
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chart import generate_chart, in_window
+from chart_cache import ChartCache, get_song_data_cached, stream_song_data_cached
+from chart_file import chart_path_for, load_chart
+
+# A chart shipped next to the song, if there is one and it was built from this exact
+# file for this difficulty. A damaged or unreadable chart file is ignored, so the
+# song is analyzed instead.
+def find_shipped_chart(song_path, difficulty):
+    chart_path = chart_path_for(song_path, difficulty)
+    if not os.path.exists(chart_path):
+        return None
+    try:
+        header, timeline = load_chart(chart_path)
+    except (OSError, ValueError, KeyError, struct.error):
+        return None
+    if header.get("difficulty") != difficulty or header.get("song_hash") != ChartCache().song_hash(song_path):
+        return None
+    return timeline
+
+# Turns (times, pitches) chunks into timelines. Lanes are spread over the pitch
+# range seen so far, since a streamed chart doesn't know the rest of the song yet.
+def build_timelines(chunks, difficulty):
+    pitch_range = None
+    for times, pitches in chunks:
+        if len(times) == 0:
+            continue
+        lo, hi = float(pitches.min()), float(pitches.max())
+        if pitch_range is not None:
+            lo, hi = min(lo, pitch_range[0]), max(hi, pitch_range[1])
+        pitch_range = (lo, hi)
+        yield generate_chart(times, pitches, difficulty, pitch_range)
+
+# The chart for a song as a sequence of timelines: a shipped chart file if there
+# is one, otherwise the (cached) analysis, streamed in chunks or in one piece. With
+# offset/duration only that part of the song is charted; it is short enough to
+# analyze in one piece, so it is never streamed.
+def chart_timelines(song_path, difficulty, stream=False, offset=0.0, duration=None):
+    windowed = offset > 0 or duration is not None
+    shipped = find_shipped_chart(song_path, difficulty)
+    if shipped is not None:
+        return [shipped[in_window(shipped.times, offset, duration)] if windowed else shipped]
+    if windowed:
+        song_data = get_song_data_cached(song_path, difficulty, offset=offset, duration=duration)
+        return build_timelines([song_data], difficulty)
+    if stream:
+        return build_timelines(stream_song_data_cached(song_path, difficulty), difficulty)
+    song_data = get_song_data_cached(song_path, difficulty)
+    return build_timelines([song_data] if song_data is not None else [], difficulty)
+
+# Niceness of the prefetch thread. On Linux each thread has its own, so this
+# only lowers the prefetch worker, not the game; elsewhere it would apply to the
+# whole process and is skipped.
+PREFETCH_NICE = 10
+
+def lower_priority():
+    if sys.platform.startswith("linux"):
+        try:
+            os.nice(PREFETCH_NICE)
+        except OSError:
+            pass
+
+# A song being decoded and charted ahead of time by prefetch_song. The sound is
+# loaded first; then each timeline is put on `chunks` as soon as it is built,
+# followed by DONE, so a load can start playing on the first chunk while the rest
+# of the song is still being analyzed.
+DONE = object()
+
+class Prefetch:
+    def __init__(self):
+        self.sound = None
+        self.chunks = queue.Queue()
+        self.cancelled = threading.Event()
+        self.future = None
+
+    # Yields the timelines in order, each as soon as it is ready, and re-raises
+    # whatever stopped the prefetch early
+    def timelines(self):
+        while (timeline := self.chunks.get()) is not DONE:
+            yield timeline
+        self.future.result()
+
+    # Stops charting at the next chunk. With release the sound is unloaded as well
+    # (once it has loaded), for a prefetch nobody is going to play.
+    def cancel(self, release=False):
+        self.cancelled.set()
+        if self.future.cancel():
+            # It never started, so nothing else will end the chunks
+            self.chunks.put(DONE)
+        elif release:
+            self.future.add_done_callback(lambda future: self.release())
+
+    def release(self):
+        if self.sound is not None:
+            self.sound.unload()
+            self.sound = None
+
+# Decodes (via load_sound) and charts a song into `prefetch`. The chart is streamed
+# so the analysis runs in short blocks, and the worker gives up the GIL between
+# them, so the game thread is never kept waiting for long.
+def prefetch_song(prefetch, song_path, difficulty, offset=0.0, duration=None, load_sound=None):
+    try:
+        prefetch.sound = load_sound(song_path) if load_sound is not None else None
+        for timeline in chart_timelines(song_path, difficulty, True, offset, duration):
+            if prefetch.cancelled.is_set():
+                return
+            prefetch.chunks.put(timeline)
+            time.sleep(0)
+    finally:
+        prefetch.chunks.put(DONE)
+
+# Generates charts on a background worker so librosa never blocks the Kivy main
+# thread. Only one chart is wanted at a time: starting a new load cancels the
+# previous one. Each load gets an id that is passed to its callbacks, and callers
+# drop anything whose id is no longer current. A queued load is dropped outright;
+# a streaming load stops at its next chunk; a full analysis that is already running
+# can't be interrupted, so it finishes (and still fills the chart cache) unseen.
+#
+# One upcoming song can also be prefetched on a second, lower-priority worker
+# (see prefetch_song). Only the most recent prefetch is kept, so at most one
+# song's sound and chart are held ahead of the one playing.
+class ChartLoader:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart-loader")
+        self.prefetcher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart-prefetch",
+                                             initializer=lower_priority)
+        self.future = None
+        self.cancelled = None
+        self.load_id = 0
+        self.prefetched = None # ((song_path, difficulty, offset, duration), Prefetch)
+
+    # on_chunk(load_id, timeline) is called from the worker with a NoteTimeline for
+    # every piece of the chart (once without streaming), on_done(load_id, future)
+    # when it ends. A chart file shipped next to the song is used as-is. With
+    # `prefetched` (a Prefetch from take_prefetched) its timelines are passed on as
+    # the prefetch builds them.
+    # offset/duration chart only that part of the song (see chart_timelines).
+    def load(self, song_path, difficulty, on_chunk, on_done=None, stream=False, prefetched=None, offset=0.0,
+             duration=None):
+        self.cancel()
+        load_id = self.load_id
+        cancelled = self.cancelled = threading.Event()
+
+        def run():
+            if prefetched is not None:
+                timelines = prefetched.timelines()
+            else:
+                timelines = chart_timelines(song_path, difficulty, stream, offset, duration)
+            for timeline in timelines:
+                if cancelled.is_set():
+                    return
+                on_chunk(load_id, timeline)
+
+        self.future = self.executor.submit(run)
+        if on_done is not None:
+            self.future.add_done_callback(lambda future: on_done(load_id, future))
+        return load_id
+
+    def is_current(self, load_id):
+        return load_id == self.load_id
+
+    def cancel(self):
+        if self.future is not None:
+            self.future.cancel()
+            self.future = None
+        if self.cancelled is not None:
+            self.cancelled.set()
+        self.load_id += 1
+
+    # Starts decoding and charting a song that will be loaded later; load_sound
+    # (e.g. SoundLoader.load) is called on the prefetch worker
+    def prefetch(self, song_path, difficulty, offset=0.0, duration=None, load_sound=None):
+        key = (song_path, difficulty, offset, duration)
+        if self.prefetched is not None and self.prefetched[0] == key:
+            return
+        self.discard_prefetch()
+        prefetch = Prefetch()
+        prefetch.future = self.prefetcher.submit(prefetch_song, prefetch, song_path, difficulty, offset, duration,
+                                                 load_sound)
+        self.prefetched = (key, prefetch)
+
+    # The Prefetch for this song, or None. It is handed over to the caller, who then
+    # owns its sound; it may still be charting.
+    def take_prefetched(self, song_path, difficulty, offset=0.0, duration=None):
+        if self.prefetched is None or self.prefetched[0] != (song_path, difficulty, offset, duration):
+            return None
+        prefetch = self.prefetched[1]
+        self.prefetched = None
+        return prefetch
+
+    def discard_prefetch(self):
+        if self.prefetched is None:
+            return
+        prefetch = self.prefetched[1]
+        self.prefetched = None
+        prefetch.cancel(release=True)
+
+    def shutdown(self):
+        self.cancel()
+        self.discard_prefetch()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.prefetcher.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,53 @@
+import os
+import time
+
+# Audio output latency calibration in seconds. Positive values mean the sound is
+# heard later than it is started, so notes are judged later to match.
+DEFAULT_OFFSET = float(os.environ.get("BEATTRACK_AUDIO_OFFSET_MS", "0")) / 1000
+# How far the monotonic clock may drift from the sound's reported position before
+# it is re-anchored. Kept above the jitter of Sound.get_pos on most backends.
+SYNC_TOLERANCE = 0.03
+
+# Song position for the game. Time comes from a monotonic clock anchored at the
+# moment playback starts; when the audio backend reports a position
+# (Sound.get_pos, which some providers always return 0 for) the anchor follows it
+# whenever the two drift apart by more than SYNC_TOLERANCE.
+class GameClock:
+    def __init__(self, offset=DEFAULT_OFFSET, clock=time.perf_counter):
+        self.offset = offset
+        self.clock = clock
+        self.anchor = None
+        self.sound = None
+        self.last_pos = 0.0
+
+    def start(self, sound=None, position=0.0):
+        self.sound = sound
+        self.last_pos = 0.0
+        self.anchor = self.clock() - position
+
+    def stop(self):
+        self.anchor = None
+        self.sound = None
+
+    @property
+    def running(self):
+        return self.anchor is not None
+
+    def position(self):
+        if self.anchor is None:
+            return 0.0
+
+        position = self.clock() - self.anchor
+        if self.sound is not None:
+            pos = self.sound.get_pos()
+            # Only trust the backend when its position actually moves
+            if pos > 0 and pos != self.last_pos:
+                self.last_pos = pos
+                if abs(pos - position) > SYNC_TOLERANCE:
+                    self.anchor = self.clock() - pos
+                    position = pos
+        return position
+
+    # Song time to judge and draw against, with the latency calibration applied
+    def now(self):
+        return self.position() - self.offset
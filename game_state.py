@@ -0,0 +1,130 @@
+import numpy as np
+
+from chart import NoteScheduler, NoteTimeline
+from judgement import HitQueues, MISS_WINDOW
+from tile_pool import TilePool
+
+# Accuracy credit for each judgement; a miss counts for nothing
+JUDGEMENT_WEIGHTS = {"perfect": 1.0, "great": 0.8, "good": 0.6, "okay": 0.4, "miss": 0.0}
+
+# Everything about a song being played that doesn't depend on drawing it: which
+# notes have spawned, which are waiting to be hit, the score and the timing error
+# of every judged press. Time is always passed in, so the same state runs under
+# the game's clock (MainWidget) or as fast as possible (simulate.py).
+#
+# Methods that remove tiles return the slots they freed, so a renderer can hide
+# whatever it draws for them.
+class GameState:
+    def __init__(self, travel_time, linger, num_lanes=4, capacity=32):
+        # Seconds before its hit time a note spawns, and after it the tile is removed
+        self.travel_time = travel_time
+        self.linger = linger
+        self.tile_pool = TilePool(capacity)
+        self.hit_queues = HitQueues(num_lanes)
+        self.scheduler = None
+        self.reset()
+
+    def reset(self):
+        self.scheduler = None
+        self.timelines = []
+        self.tile_pool.clear()
+        self.hit_queues.clear()
+        self.score = dict.fromkeys(("miss", "okay", "good", "great", "perfect"), 0)
+        self.combo = 0
+        self.max_combo = 0
+        self.errors = []
+
+    @property
+    def started(self):
+        return self.scheduler is not None
+
+    # Adds a chart (or the next streamed piece of one)
+    def add_timeline(self, timeline):
+        self.timelines.append(timeline)
+        if self.scheduler is None:
+            self.scheduler = NoteScheduler(timeline, window=self.travel_time)
+        else:
+            self.scheduler.extend(timeline)
+
+    # Every note added so far, including the ones the scheduler has already dropped
+    def chart(self):
+        return NoteTimeline.concatenate(self.timelines) if self.timelines else NoteTimeline([], [], [], [])
+
+    def finished(self):
+        return self.scheduler is not None and self.scheduler.finished() and len(self.tile_pool) == 0
+
+    # Spawns every note due by `now` and returns the new slots
+    def spawn_due(self, now):
+        if self.scheduler is None:
+            return []
+
+        timeline = self.scheduler.timeline
+        pool = self.tile_pool
+        spawned = []
+        for i in self.scheduler.due(now):
+            lane = int(timeline.lanes[i])
+            slot = pool.spawn(lane, timeline.times[i])
+            self.hit_queues.push(lane, timeline.times[i], slot, pool.serial[slot])
+            spawned.append(slot)
+        return spawned
+
+    # Scores notes that are too late to hit as misses. Their tiles stay until
+    # remove_passed, so a missed note keeps falling past the buttons.
+    def expire(self, now):
+        for slot, serial in self.hit_queues.expire(now):
+            self.add_judgement("miss")
+
+    # Despawns tiles whose hit time is more than `linger` seconds behind `now`
+    def remove_passed(self, now):
+        pool = self.tile_pool
+        active = pool.active()
+        passed = active[pool.time[active] < now - self.linger]
+        for slot in passed:
+            pool.despawn(slot)
+        return passed
+
+    # Spawns, expires and removes everything up to `now`; returns (spawned, removed)
+    def advance(self, now):
+        spawned = self.spawn_due(now)
+        self.expire(now)
+        return spawned, self.remove_passed(now)
+
+    # Judges a press in `lane` at `now`. Returns (judgement, error, freed slot or
+    # None), or None if the lane had nothing close enough to press. Notes already
+    # too late at `now` are missed first, so the result depends only on the press
+    # time and never on when the last frame ran.
+    def press(self, lane, now):
+        self.expire(now)
+        result = self.hit_queues.judge(lane, now)
+        if result is None:
+            return None
+
+        judgement, error, slot, serial = result
+        self.add_judgement(judgement)
+        self.errors.append(error)
+        if not self.tile_pool.is_alive(slot, serial):
+            return judgement, error, None
+        self.tile_pool.despawn(slot)
+        return judgement, error, slot
+
+    def add_judgement(self, judgement):
+        self.score[judgement] += 1
+        if judgement == "miss":
+            self.combo = 0
+        else:
+            self.combo += 1
+            self.max_combo = max(self.max_combo, self.combo)
+
+    def accuracy(self):
+        total = sum(self.score.values())
+        if total == 0:
+            return 100.0
+        return sum(JUDGEMENT_WEIGHTS[j] * n for j, n in self.score.items()) / total * 100
+
+    # Histogram of press timing errors (press time - note time) in seconds; the
+    # default bins cover every press that can be judged, in 5 ms steps
+    def error_histogram(self, bins=None):
+        if bins is None:
+            bins = np.linspace(-MISS_WINDOW, MISS_WINDOW, int(round(2 * MISS_WINDOW / 0.005)) + 1)
+        counts, edges = np.histogram(self.errors, bins=bins)
+        return counts, edges
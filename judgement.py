@@ -0,0 +1,52 @@
+from collections import deque
+
+# Hit windows in seconds, checked in order against |press time - note time|
+JUDGEMENT_WINDOWS = (("perfect", 0.025), ("great", 0.050), ("good", 0.090), ("okay", 0.150))
+# A press this early (but outside the okay window) still consumes the note as a miss
+MISS_WINDOW = 0.250
+# How late a note can be before it counts as missed without a press
+LATE_WINDOW = JUDGEMENT_WINDOWS[-1][1]
+
+def judge_error(error):
+    error = abs(error)
+    for judgement, window in JUDGEMENT_WINDOWS:
+        if error <= window:
+            return judgement
+    return "miss"
+
+# One queue of pending notes per lane, ordered by the time the note should be hit.
+# A key press only ever looks at the head of its lane, so judging is O(1) and
+# depends on time alone, not on frame rate or where the tile is drawn.
+class HitQueues:
+    def __init__(self, num_lanes=4):
+        self.lanes = [deque() for _ in range(num_lanes)]
+
+    def push(self, lane, hit_time, slot, serial):
+        self.lanes[lane].append((hit_time, slot, serial))
+
+    # Returns (judgement, error, slot, serial) for the note a press at `now` hits,
+    # or None if the lane has nothing close enough to press
+    def judge(self, lane, now):
+        queue = self.lanes[lane]
+        if not queue:
+            return None
+
+        hit_time, slot, serial = queue[0]
+        error = now - hit_time
+        if error < -MISS_WINDOW:
+            return None
+        queue.popleft()
+        return judge_error(error), error, slot, serial
+
+    # Pops every note that is now too late to hit and returns their (slot, serial)
+    def expire(self, now):
+        expired = []
+        for queue in self.lanes:
+            while queue and queue[0][0] + LATE_WINDOW < now:
+                hit_time, slot, serial = queue.popleft()
+                expired.append((slot, serial))
+        return expired
+
+    def clear(self):
+        for queue in self.lanes:
+            queue.clear()
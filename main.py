@@ -7,16 +7,25 @@ from kivy import platform
 from kivy.app import App
 from kivy.uix.relativelayout import RelativeLayout
 from kivy.properties import NumericProperty, Clock, ObjectProperty, StringProperty
+from kivy.clock import mainthread
+from kivy.graphics import InstructionGroup
 from kivy.graphics.context_instructions import Color
 from kivy.graphics.vertex_instructions import Line, Quad, Triangle
 from kivy.lang.builder import Builder
 from kivy.core.audio import SoundLoader
 from kivy.metrics import dp
-import random
+import sys
 import time
-from itertools import islice
 
-from audio_handling import get_song_data
+import numpy as np
+
+from chart_cache import ChartCache
+from chart_loader import ChartLoader
+from game_clock import GameClock
+from game_state import GameState
+import perf
+import replay
+from session import SongQueue
 
 class MainWidget(RelativeLayout):
     NUM_LINES = 5
@@ -24,9 +33,12 @@ class MainWidget(RelativeLayout):
     BTN_HEIGHT = 0.05
     BTN_OFFSET_Y = 0.03
     BTN_TRANSPARENCY = 0.25
-    NUM_TILES = 30
-    SPEED = 0.005
-    PRESS_THRESHOLD = 0.05
+    NUM_TILES = 32 # initial tile pool capacity, grows as needed
+    SPEED = 0.005 # fraction of screen height a tile falls every 1/60 s
+    # Seconds a tile takes from spawning at the top to reaching the buttons
+    TRAVEL_TIME = (1.1 - BTN_OFFSET_Y) / (SPEED * 60)
+    # Seconds past its hit time a tile keeps falling until it is below the screen
+    LINGER_TIME = (BTN_OFFSET_Y + BTN_HEIGHT) / (SPEED * 60)
     
     lines = []
     
@@ -44,32 +56,47 @@ class MainWidget(RelativeLayout):
     b4color = None
     
     tile_colors = []
-    tile_coordinates = []
+    tile_group = None
+    state = None
+    LANE_COLORS = [(0, 0.9, 0, 1), (0.9, 0, 0, 1), (0, 0, 0.9, 1), (0.9, 0.9, 0, 1)]
     
     keybinds = {"b1":"a", "b2":"s", "b3":"k", "b4":"l"}
+    key_lanes = {} # keycode -> lane, built from keybinds
     pressed_keys = set()
+    recorder = None
     
     background = None
     
     button_coords = [[(0, 0) for _ in range(4)] for _ in range(4)]
+    lane_x = [0, 0, 0, 0]
     
     tiles = []
     
 
-    song_data = None
+    stream_chart = True
     time_elapsed = 0
-    time_start = 0
+    clock = None
     
-    song_path = 'audio/field.wav'
+    song_path = 'audio/field.wav' # played when no songs are given on the command line
     song = None
     difficulty = "medium"
+    queue = None
+    prefetched = None
+    start_time = 0 # song time playback starts from
+    song_end = None # song time playback stops at, if not the end of the song
+    SKIP_DELAY = 2.0 # seconds a song that can't be played shows why before the next one loads
     
-    score = {"miss": 0, "okay": 0, "good": 0, "great": 0, "perfect": 0}
-    
-    combo = 0
     multiplier = 1
     
     stat_txt = StringProperty("COMBO: 0\nACCURACY: 100.0%\nPERFECT: 0")
+    status_txt = StringProperty("")
+    perf_txt = StringProperty("")
+    show_perf = perf.ENABLED # toggled with F3 when BEATTRACK_PERF is set
+    perf_updated = 0
+    
+    chart_loader = None
+    chart_id = None
+    load_start = 0
     
     def __init__(self, **kwargs):
         super(MainWidget, self).__init__(**kwargs)
@@ -77,45 +104,185 @@ class MainWidget(RelativeLayout):
         self.init_buttons()
         self.init_tiles()
         self.init_lines()
-        self.init_audio()
+        
+        # Lanes, buttons and the background only move when the window or the
+        # perspective point does, so they aren't redrawn every frame
+        self.bind(size=self.update_geometry,
+                  perspective_point_x=self.update_geometry,
+                  perspective_point_y=self.update_geometry)
+        self.update_geometry()
         
         self.keyboard = Window.request_keyboard(self.keyboard_closed, self)
         self.keyboard.bind(on_key_down=self.on_keyboard_down)
         self.keyboard.bind(on_key_up=self.on_keyboard_up)
+        self.key_lanes = {self.keyboard.string_to_keycode(key): int(button[1]) - 1
+                          for button, key in self.keybinds.items()}
+        if replay.ENABLED:
+            self.recorder = replay.InputRecorder()
         
-        self.song_data = get_song_data(self.song_path, self.difficulty)
-        
+        self.chart_loader = ChartLoader()
+        self.clock = GameClock()
         Clock.schedule_interval(self.update, 1/60)
-        
-        Clock.schedule_interval(self.update_clock, 0.001)
-        
-        self.time_start = time.time()
-        Clock.schedule_interval(self.place_tiles, 0.001)
-        self.song.play()
+        self.queue = SongQueue(sys.argv[1:] or [self.song_path], self.difficulty)
+        self.play_next()
     
     def init_audio(self):
         self.song = SoundLoader.load(self.song_path)
+    
+    # Moves on to the next song in the queue, or ends the session when it is empty
+    def play_next(self):
+        entry = self.queue.next()
+        if entry is None:
+            self.save_replay()
+            self.clock.stop()
+            self.status_txt = "SESSION COMPLETE"
+            return
+        self.load_song(*entry)
+    
+    # Starts generating the chart in the background. Playback and tile scheduling
+    # begin with the first chunk of the chart in on_chart_chunk; with stream_chart
+    # that arrives after a few seconds of audio are analyzed, and the rest keeps
+    # arriving while the song plays. Calling this again (new song or difficulty)
+    # stops the current song and cancels the pending chart.
+    #
+    # If the song was prefetched while the previous one played, its sound and chart
+    # come from the prefetch instead, chunk by chunk as the prefetch charts them.
+    #
+    # With start/duration only that section is charted and played, e.g. to
+    # practice part of a song; only the section is analyzed, so it loads quickly.
+    def load_song(self, song_path, difficulty, start=0.0, duration=None):
+        self.stop_song()
+        self.song_path = song_path
+        self.difficulty = difficulty
+        self.start_time = start
+        self.song_end = start + duration if duration is not None else None
+        self.prefetched = self.chart_loader.take_prefetched(song_path, difficulty, start, duration)
+        if self.prefetched is None:
+            self.init_audio()
+        
+        self.load_start = time.time()
+        self.status_txt = "LOADING"
+        self.chart_id = self.chart_loader.load(song_path, difficulty, on_chunk=self.on_chart_chunk,
+                                               on_done=self.on_chart_loaded, stream=self.stream_chart,
+                                               prefetched=self.prefetched, offset=start, duration=duration)
+    
+    # Stops playback and frees the song's sound, so only the playing song and at
+    # most one prefetched song are held in memory
+    def stop_song(self):
+        self.save_replay()
+        self.clock.stop()
+        if self.prefetched is not None:
+            # Its sound is only ours to free if it never started playing as self.song
+            self.prefetched.cancel(release=self.song is None)
+            self.prefetched = None
+        if self.song is not None:
+            self.song.stop()
+            self.song.unload()
+            self.song = None
+        for slot in self.state.tile_pool.active():
+            self.tile_colors[slot].a = 0
+        self.state.reset()
+        self.time_elapsed = 0
+    
+    @mainthread
+    def on_chart_chunk(self, chart_id, timeline):
+        if not self.chart_loader.is_current(chart_id) or len(timeline) == 0:
+            return
+        
+        started = self.state.started
+        self.state.add_timeline(timeline)
+        if not started:
+            if self.song is None and self.prefetched is not None:
+                # The prefetch loads the sound before it queues any chunk
+                self.song = self.prefetched.sound
+            if self.song is None:
+                self.init_audio()
+            if self.song is None:
+                # SoundLoader couldn't open the file; drop the rest of its chart
+                self.chart_loader.cancel()
+                self.skip_song("FAILED TO LOAD SONG")
+                return
+            self.start_playback()
+    
+    @mainthread
+    def on_chart_loaded(self, chart_id, future):
+        if not self.chart_loader.is_current(chart_id) or future.cancelled():
+            return
+        
+        error = future.exception()
+        if error is not None:
+            self.skip_song(f"FAILED TO LOAD CHART\n{error}")
+        elif not self.state.started:
+            self.skip_song("NO NOTES FOUND")
+    
+    # Shows why the current song can't be played and moves on to the next one after
+    # SKIP_DELAY, so one bad file doesn't stop the rest of the queue. Nothing happens
+    # if another song has been loaded in the meantime.
+    def skip_song(self, status):
+        self.status_txt = status
+        load_id = self.chart_loader.load_id
+        Clock.schedule_once(lambda dt: self.chart_loader.is_current(load_id) and self.play_next(), self.SKIP_DELAY)
+    
+    # Writes the key events of the song that is stopping to a replay file
+    def save_replay(self):
+        if self.recorder is None or len(self.recorder) == 0 or not self.state.started:
+            return
+        try:
+            song_hash = ChartCache().song_hash(self.song_path)
+            path = replay.save_session_replay(self.state.chart(), self.recorder, self.song_path, song_hash,
+                                              self.difficulty, self.clock.offset)
+            print(f"saved replay {path}")
+        except OSError as e:
+            print(f"could not save replay: {e}")
+        self.recorder.clear()
+    
+    def start_playback(self):
+        self.status_txt = ""
+        
+        # Anchor the clock after play() so chart time matches what is heard
+        self.song.play()
+        if self.start_time > 0:
+            self.song.seek(self.start_time)
+        self.clock.start(self.song, self.start_time)
+        
+        upcoming = self.queue.peek()
+        if upcoming is not None:
+            self.chart_loader.prefetch(*upcoming, load_sound=SoundLoader.load)
         
     def keyboard_closed(self):
         self.keyboard.unbind(on_key_down=self.on_keyboard_down)
         self.keyboard.unbind(on_key_up=self.on_keyboard_up)
         self.keyboard = None
         
+    # Key events are stamped with song time before anything else happens, and the
+    # press is judged at that time, so work done before the handler ran (or in it)
+    # doesn't count against the player
     def on_keyboard_down(self, keyboard, keycode, text, modifiers):
-        for button, key in self.keybinds.items():
-            if keycode[1] == key:
-                self.button_pressed(button)
-                if key not in self.pressed_keys:
-                    self.tile_pressed(int(button[1]))
-                self.pressed_keys.add(key)
-                break
+        now = self.clock.now()
+        lane = self.key_lanes.get(keycode[0])
+        if lane is None:
+            if keycode[1] == "f3" and perf.ENABLED:
+                self.show_perf = not self.show_perf
+                self.perf_txt = ""
+            return
+        
+        # Holding a key repeats key down events; only the first one is a press
+        if keycode[0] in self.pressed_keys:
+            return
+        self.pressed_keys.add(keycode[0])
+        self.tile_pressed(lane, now)
+        self.button_pressed(f"b{lane + 1}")
                 
     def on_keyboard_up(self, keyboard, keycode):
-        for button, key in self.keybinds.items():
-            if keycode[1] == key and key in self.pressed_keys:
-                self.button_released(button)
-                self.pressed_keys.remove(key)
-                break
+        now = self.clock.now()
+        lane = self.key_lanes.get(keycode[0])
+        if lane is None or keycode[0] not in self.pressed_keys:
+            return
+        
+        self.pressed_keys.remove(keycode[0])
+        if self.recorder is not None and self.clock.running:
+            self.recorder.record(now, lane, down=False)
+        self.button_released(f"b{lane + 1}")
     
     def button_pressed(self, button):
         match button:
@@ -139,156 +306,87 @@ class MainWidget(RelativeLayout):
             case "b4":
                 self.b4color.rgba = (1, 1, 0, self.BTN_TRANSPARENCY)
     
-    def tile_pressed(self, line):
-        line_x = 0
-        match line:
-            case 1:
-                line_x = self.get_line_x_by_index(-2)
-            case 2:
-                line_x = self.get_line_x_by_index(-1)
-            case 3:
-                line_x = self.get_line_x_by_index(0)
-            case 4:
-                line_x = self.get_line_x_by_index(1)
-        
-        for i, tile in enumerate(self.tile_coordinates):
-            btn_height = self.height * self.BTN_HEIGHT
-            thres_height = self.height * self.PRESS_THRESHOLD
-            diff_y = abs(tile[1] - self.button_coords[line - 1][0][1]) # y coordinate of tile subtracted from LH corner of button
-            
-            if diff_y > btn_height + thres_height:
-                continue
-            elif tile[0] == line_x:
-                # Add to current score based on accuracy of button press
-                if diff_y <= btn_height * 0.05:
-                    self.score["perfect"] += 1
-                    self.combo += 1
-                elif diff_y <= btn_height * 0.2:
-                    self.score["great"] += 1
-                    self.combo += 1
-                elif diff_y <= btn_height * 0.4:
-                    self.score["good"] += 1
-                    self.combo += 1
-                elif diff_y <= btn_height * 0.9:
-                    self.score["okay"] += 1
-                    self.combo += 1
-                else:
-                    self.score["miss"] += 1
-                    self.combo = 0
-                
-                del self.tile_coordinates[i]
-                break
+    # Timed as "press_handler": the time spent judging a press, not input latency
+    # (the press is stamped before this runs)
+    @perf.timed("press_handler")
+    def tile_pressed(self, lane, now):
+        if self.recorder is not None and self.clock.running:
+            self.recorder.record(now, lane, down=True)
+        result = self.state.press(lane, now)
+        if result is not None and result[2] is not None:
+            self.tile_colors[result[2]].a = 0
 
     def init_tiles(self):
-        for i in range(self.NUM_TILES):
-            with self.canvas:
-                self.tile_colors.append(Color(1, 1, 1))
-                self.tiles.append(Quad())
-                
-    def place_tiles(self, dt):
-        l1 = self.get_line_x_by_index(-2)
-        l2 = self.get_line_x_by_index(-1)
-        l3 = self.get_line_x_by_index(0)
-        l4 = self.get_line_x_by_index(1)
-        pitchMax = max(self.song_data.values())
-        pitchMin = min(self.song_data.values())
-        times = list(self.song_data.keys())
+        self.state = GameState(self.TRAVEL_TIME, self.LINGER_TIME, len(self.LANE_COLORS), self.NUM_TILES)
+        self.tile_group = InstructionGroup()
+        self.canvas.add(self.tile_group)
+        self.ensure_tile_instructions()
+    
+    # One Color/Quad pair per pool slot, created once and reused by every tile
+    # that occupies the slot
+    def ensure_tile_instructions(self):
+        for i in range(len(self.tiles), self.state.tile_pool.capacity):
+            color = Color(1, 1, 1, 0)
+            tile = Quad(points=(0, 0, 0, 0, 0, 0, 0, 0))
+            self.tile_group.add(color)
+            self.tile_group.add(tile)
+            self.tile_colors.append(color)
+            self.tiles.append(tile)
+    
+    # Spawns every note that is due to appear at the top by song time `now`
+    @perf.timed("place_tiles")
+    def place_tiles(self, now):
+        spawned = self.state.spawn_due(now)
+        if not spawned:
+            return
         
+        pool = self.state.tile_pool
+        self.ensure_tile_instructions()
+        for slot in spawned:
+            if perf.ENABLED:
+                # How long after its scheduled spawn time the note actually appeared.
+                # Notes scheduled before playback started all appear on the first
+                # frame, which says nothing about how the game keeps up, so they
+                # aren't counted.
+                spawn_time = pool.time[slot] - self.TRAVEL_TIME
+                if spawn_time >= self.start_time:
+                    perf.record("spawn_late", now - spawn_time)
+            self.tile_colors[slot].rgba = self.LANE_COLORS[pool.lane[slot]]
+    
+    # Tile y is a function of how far its note is from `now`, so a dropped frame
+    # never puts tiles out of sync with the song
+    @perf.timed("update_tiles")
+    def update_tiles(self, now):
+        self.state.expire(now)
+        # Missed notes are already scored by expire; this only clears them off screen
+        for slot in self.state.remove_passed(now):
+            self.tile_colors[slot].a = 0
         
-        top = self.height * 1.1
-        # tile_height = self.height * self.BTN_HEIGHT
-        for i, (btime, pitch) in enumerate(self.song_data.items()):
-            if (btime - 0.08) <= self.time_elapsed <= (btime + 0.08) and self.NUM_TILES > len(self.tile_coordinates):
-                rng = [1, 2, 3, 4]
-                rep = 1
-                if i < len(self.song_data) - 2:
-                    if abs(times[i + 1] - times[i]) <= 0.15 and abs(times[i + 2] - times[i + 1]) <= 0.15:
-                        rep += 2
-                    elif abs(times[i + 1] - times[i]) <= 0.15:
-                        rep += 1
-                
-                ### NOTE: GET AVERAGE OF PITCH INSTEAD OF MIN AND MAX
-                if pitchMin <= pitch < int(pitchMax * 0.25):
-                    self.tile_coordinates.append((l1, top))
-                    rng.remove(1)
-                elif int(pitchMin * 0.25) <= pitch < int(pitchMax * 0.5):
-                    self.tile_coordinates.append((l2, top))
-                    rng.remove(2)
-                elif int(pitchMin * 0.5) <= pitch < int(pitchMin * 0.75):
-                    self.tile_coordinates.append((l3, top))
-                    rng.remove(3)
-                elif int(pitchMin * 0.75) <= pitch <= pitchMax:
-                    self.tile_coordinates.append((l4, top))    
-                    rng.remove(4)    
-                
-                print(f'beat time: {btime} actual time: {self.time_elapsed} pitch: {pitch} reps: {rep}')
-                
-                for k in range(rep - 1):
-                    r = random.choice(rng)
-                    
-                    match r:
-                        case 1:
-                            self.tile_coordinates.append((l1, top))
-                        case 2:
-                            self.tile_coordinates.append((l2, top))
-                        case 3:
-                            self.tile_coordinates.append((l3, top))
-                        case 4:
-                            self.tile_coordinates.append((l4, top))
-                    
-                    rng.remove(r)
-                    
-                for j in range(rep):
-                    del self.song_data[next(islice(self.song_data, i + j, None))]
-                break
-    
-    def update_tiles(self):
-        if len(self.tile_coordinates) > 0:
-            for i in range(len(self.tile_coordinates)-1, -1, -1):
-                if self.tile_coordinates[i][1] < self.height * self.BTN_HEIGHT * -1:
-                    del self.tile_coordinates[i]
-                    self.score['miss'] += 1
-                    self.combo = 0
-                    
-        if len(self.tile_coordinates) > 0:
-            l1 = self.get_line_x_by_index(-2)
-            l2 = self.get_line_x_by_index(-1)
-            l3 = self.get_line_x_by_index(0)
-            l4 = self.get_line_x_by_index(1)
-            
-            for i in range(len(self.tile_coordinates)):
-                movement = self.SPEED * self.height
-                self.tile_coordinates[i] = (self.tile_coordinates[i][0], self.tile_coordinates[i][1] - movement)
-                
-                tile = self.tiles[i]
-                coords = self.tile_coordinates[i]
-
-                tile_width = self.width * self.LINE_SPACING
-                tile_height = self.height * self.BTN_HEIGHT
-                
-                xmin = coords[0]
-                xmax = coords[0] + tile_width
-                ymin = coords[1]
-                ymax = coords[1] + tile_height
-                
-                x1, y1 = self.transform(xmin, ymin)
-                x2, y2 = self.transform(xmin, ymax)
-                x3, y3 = self.transform(xmax, ymax)
-                x4, y4 = self.transform(xmax, ymin)
-                
-                tile.points = (x1, y1, x2, y2, x3, y3, x4, y4)
-                
-                x = self.tile_coordinates[i][0]
-                if x == l1:
-                    self.tile_colors[i].rgba = (0, 0.9, 0, 1)
-                elif x == l2:
-                    self.tile_colors[i].rgba = (0.9, 0, 0, 1)
-                elif x == l3:
-                    self.tile_colors[i].rgba = (0, 0, 0.9, 1)
-                elif x == l4:
-                    self.tile_colors[i].rgba = (0.9, 0.9, 0, 1)
+        pool = self.state.tile_pool
+        active = pool.active()
+        if len(active) == 0:
+            return
+        
+        speed = self.SPEED * 60 * self.height
+        pool.y[active] = self.BTN_OFFSET_Y * self.height + (pool.time[active] - now) * speed
+        self.draw_tiles(active)
+    
+    @perf.timed("canvas")
+    def draw_tiles(self, active):
+        pool = self.state.tile_pool
+        # Transform the corners of every active tile in one go
+        xmin = np.array(self.lane_x)[pool.lane[active]]
+        xmax = xmin + self.width * self.LINE_SPACING
+        ymin = pool.y[active]
+        ymax = ymin + self.height * self.BTN_HEIGHT
         
+        tr_x, tr_y = self.transform_array(np.stack([xmin, xmin, xmax, xmax], axis=1),
+                                          np.stack([ymin, ymax, ymax, ymin], axis=1))
+        points = np.stack([tr_x, tr_y], axis=2).reshape(len(active), 8).tolist()
         
+        tiles = self.tiles
+        for slot, tile_points in zip(active.tolist(), points):
+            tiles[slot].points = tile_points
         
     def init_background(self):
         with self.canvas:
@@ -341,6 +439,17 @@ class MainWidget(RelativeLayout):
         
         return int(tr_x), int(tr_y)
     
+    # Same as transform, over arrays of points
+    def transform_array(self, x, y):
+        lin_y = np.minimum(y * self.perspective_point_y / self.height, self.perspective_point_y)
+        
+        factor_y = ((self.perspective_point_y - lin_y) / self.perspective_point_y) ** 3
+        
+        tr_x = self.perspective_point_x + (x - self.perspective_point_x) * factor_y
+        tr_y = self.perspective_point_y - factor_y * self.perspective_point_y
+        
+        return tr_x.astype(int), tr_y.astype(int)
+    
     def init_buttons(self):
         with self.canvas:
             self.b1color = Color(0, 1, 0, self.BTN_TRANSPARENCY)
@@ -392,24 +501,48 @@ class MainWidget(RelativeLayout):
             currIndex += 1
     
     def update_stat_txt(self):
-        total = sum(self.score.values())
-        weighted = self.score['perfect'] + self.score['great'] * 0.8 + self.score['good'] * 0.6 + self.score['okay'] * 0.4
-        accuracy = (weighted / total) * 100 if total > 0 else 100
-        self.stat_txt = f"COMBO: {self.combo}\nACCURACY: {'{:.1f}'.format(accuracy)}\nPERFECT: {self.score['perfect']}"
+        state = self.state
+        self.stat_txt = f"COMBO: {state.combo}\nACCURACY: {'{:.1f}'.format(state.accuracy())}\nPERFECT: {state.score['perfect']}"
             
-    def update_clock(self, dt):
-        self.time_elapsed = time.time() - self.time_start
+    def update_status_txt(self):
+        if self.status_txt.startswith("LOADING"):
+            dots = int((time.time() - self.load_start) * 2) % 4
+            self.status_txt = "LOADING" + "." * dots
             
-    def update(self, dt):
-        time_factor = dt*60
+    # Overlay of frame timings (see perf.py), refreshed a few times a second
+    def update_perf_txt(self):
+        if not self.show_perf or time.time() - self.perf_updated < 0.25:
+            return
+        self.perf_updated = time.time()
+        self.perf_txt = perf.overlay_text("PERF ms p50 / p95 / p99", f"tiles: {len(self.state.tile_pool)}")
+            
+    def update_geometry(self, *args):
+        self.lane_x = [self.get_line_x_by_index(i) for i in range(-2, 2)]
         self.update_background()
         self.update_lines()
         self.update_buttons()
-        self.update_tiles()
+            
+    @perf.timed("frame")
+    def update(self, dt):
+        if perf.ENABLED:
+            perf.record("frame_interval", dt)
+        if self.clock.running:
+            self.time_elapsed = self.clock.now()
+            # Switch to the next song on the first frame after this one (or its section) ends
+            if 0 < (self.song_end or self.song.length) <= self.clock.position():
+                self.play_next()
+                return
+            self.place_tiles(self.time_elapsed)
+        self.update_tiles(self.time_elapsed)
         self.update_stat_txt()
+        self.update_status_txt()
+        self.update_perf_txt()
 
 class BeatTrackApp(App):
-    pass
+    def on_stop(self):
+        self.root.stop_song()
+        self.root.chart_loader.shutdown()
 
-BeatTrackApp().run()
+if __name__ == "__main__":
+    BeatTrackApp().run()
     
\ No newline at end of file
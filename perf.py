@@ -0,0 +1,92 @@
+import functools
+import gc
+import os
+import time
+
+import numpy as np
+
+# Hot-path timing, switched on with BEATTRACK_PERF=1. When it is off, timed()
+# hands back the function it decorates unchanged and record() is never reached
+# from the game loop (callers check ENABLED first), so there is no per-frame cost.
+ENABLED = os.environ.get("BEATTRACK_PERF", "0") not in ("", "0")
+# Samples kept per metric; at 60 fps this is a bit over 8 seconds of frames
+HISTORY = 512
+
+# Fixed-size buffer of the most recent samples of one metric
+class RingBuffer:
+    def __init__(self, capacity=HISTORY):
+        self.values = np.zeros(capacity, dtype=np.float64)
+        self.count = 0
+
+    def append(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, len(self.values))
+
+    def recent(self):
+        return self.values[:len(self)]
+
+    def percentiles(self, qs):
+        if self.count == 0:
+            return [float("nan")] * len(qs)
+        return np.percentile(self.recent(), qs).tolist()
+
+# Named ring buffers. Analysis stages record from the chart loader's thread; a
+# sample written while the overlay reads is at worst one stale value.
+class PerfRecorder:
+    def __init__(self, capacity=HISTORY):
+        self.capacity = capacity
+        self.buffers = {}
+        self.gc_start = None
+
+    def record(self, name, value):
+        buffer = self.buffers.get(name)
+        if buffer is None:
+            buffer = self.buffers[name] = RingBuffer(self.capacity)
+        buffer.append(value)
+
+    def percentiles(self, name, qs=(50, 95, 99)):
+        buffer = self.buffers.get(name)
+        return buffer.percentiles(qs) if buffer is not None else [float("nan")] * len(qs)
+
+    # Times every garbage collection (all generations) as "gc"
+    def on_gc(self, phase, info):
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        elif self.gc_start is not None:
+            self.record("gc", time.perf_counter() - self.gc_start)
+            self.gc_start = None
+
+recorder = PerfRecorder()
+if ENABLED:
+    gc.callbacks.append(recorder.on_gc)
+
+def record(name, value):
+    recorder.record(name, value)
+
+# Decorator recording how long each call takes under `name`, in seconds
+def timed(name):
+    def decorate(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                recorder.record(name, time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+# Text for the in-game overlay: percentiles in milliseconds for each metric
+# recorded so far, plus any extra lines the caller passes in
+def overlay_text(*extra):
+    lines = list(extra)
+    for name in sorted(recorder.buffers):
+        p50, p95, p99 = (value * 1000 for value in recorder.percentiles(name))
+        lines.append(f"{name}: {p50:.2f} / {p95:.2f} / {p99:.2f}")
+    return "\n".join(lines)
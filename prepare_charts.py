@@ -0,0 +1,113 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_handling import DEFAULT_PROFILE, PROFILES
+from chart import DIFFICULTIES, generate_chart
+from chart_cache import CACHE_DIR, CACHE_VERSION, MAX_CACHE_BYTES, ChartCache, cache_song
+from chart_file import chart_path_for, read_chart_header, save_chart
+
+AUDIO_EXTENSIONS = (".wav", ".mp3", ".flac", ".ogg", ".m4a", ".aiff", ".aif")
+
+# Pre-builds charts for a whole music library into the chart cache, one song per
+# worker process, so the game never has to analyze them at load time. With
+# --export each chart is also written as a .btc file next to its song, which is
+# how charts are shipped with songs.
+#
+#   python prepare_charts.py ~/Music --jobs 8 --export
+
+def find_songs(root):
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if name.lower().endswith(AUDIO_EXTENSIONS):
+                yield os.path.join(dirpath, name)
+
+def chart_is_current(chart_path, song_hash, params):
+    try:
+        header = read_chart_header(chart_path)
+    except (OSError, ValueError):
+        return False
+    return (header["song_hash"] == song_hash and header["params"] == params
+            and header.get("cache_version") == CACHE_VERSION)
+
+# Writes a .btc next to the song for every difficulty whose exported chart is
+# missing or stale, from the (already filled) chart cache
+def export_charts(audio_path, difficulties, cache, profile):
+    song_hash = cache.song_hash(audio_path)
+    params = PROFILES[profile]
+    exported = []
+    for difficulty in difficulties:
+        chart_path = chart_path_for(audio_path, difficulty)
+        if chart_is_current(chart_path, song_hash, params):
+            continue
+        entry = cache.load(cache.key_for(audio_path, difficulty, params))
+        if entry is None:
+            continue
+        save_chart(chart_path, generate_chart(*entry, difficulty), song_hash, difficulty, params, CACHE_VERSION)
+        exported.append(difficulty)
+    return exported
+
+def prepare_song(audio_path, difficulties, cache_dir, max_bytes, profile, export):
+    start = time.perf_counter()
+    cache = ChartCache(cache_dir, max_bytes)
+    built, duration = cache_song(audio_path, difficulties, cache, profile)
+    exported = export_charts(audio_path, difficulties, cache, profile) if export else []
+    return built, exported, duration, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Build beat-track charts for every song under a directory.")
+    parser.add_argument("library", help="directory to scan for audio files")
+    parser.add_argument("-d", "--difficulty", action="append", choices=DIFFICULTIES,
+                        help="difficulty to build (repeatable, default: all)")
+    parser.add_argument("-p", "--profile", choices=PROFILES, default=DEFAULT_PROFILE, help="analysis profile")
+    parser.add_argument("-e", "--export", action="store_true", help="also write a .btc chart file next to each song")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--max-cache-mb", type=int, default=MAX_CACHE_BYTES // (1024 * 1024))
+    args = parser.parse_args()
+
+    difficulties = args.difficulty or list(DIFFICULTIES)
+    max_bytes = args.max_cache_mb * 1024 * 1024
+    songs = list(find_songs(args.library))
+    print(f"{len(songs)} songs, difficulties: {', '.join(difficulties)}, profile: {args.profile}, {args.jobs} workers")
+
+    built_songs = 0
+    skipped = 0
+    failed = 0
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(prepare_song, path, difficulties, args.cache_dir, max_bytes, args.profile,
+                               args.export): path for path in songs}
+        for done, future in enumerate(as_completed(futures), 1):
+            path = futures[future]
+            prefix = f"[{done:>{len(str(len(songs)))}}/{len(songs)}]"
+            try:
+                built, exported, duration, elapsed = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"{prefix} FAILED {path}: {e}")
+                continue
+
+            if duration is None:
+                if exported:
+                    print(f"{prefix} exported {','.join(exported)}  {path}")
+                else:
+                    skipped += 1
+                    print(f"{prefix} up to date  {path}")
+                continue
+
+            built_songs += 1
+            audio_seconds += duration
+            print(f"{prefix} {elapsed:6.2f}s  {duration:7.1f}s audio  {duration / elapsed:6.1f}x  "
+                  f"{','.join(built) or '-'}  {path}")
+
+    wall = time.perf_counter() - start
+    print(f"\nbuilt {built_songs}, up to date {skipped}, failed {failed} in {wall:.1f}s")
+    if wall > 0:
+        print(f"{built_songs / wall * 60:.1f} songs/min, {audio_seconds / wall:.1f} audio-seconds per wall-second")
+
+if __name__ == "__main__":
+    main()
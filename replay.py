@@ -0,0 +1,114 @@
+import json
+import os
+import struct
+import time
+from array import array
+
+import numpy as np
+
+from chart import NoteTimeline
+from chart_file import ARRAYS as CHART_ARRAYS
+
+# Replays are recorded when BEATTRACK_RECORD=1 and saved here when a song stops
+ENABLED = os.environ.get("BEATTRACK_RECORD", "0") not in ("", "0")
+REPLAY_DIR = os.path.join(os.path.expanduser("~"), ".beattrack", "replays")
+
+# Replay file (.btr) layout, little-endian. A replay carries the chart it was
+# played against, so it reproduces the same judgements even if chart generation
+# changes later:
+#
+#   8 bytes   magic b"BTREPLAY"
+#   uint32    format version
+#   uint32    length of the JSON header
+#   ...       JSON header: song_path, song_hash, difficulty, offset, notes, events, created
+#   ...       zero padding to an 8-byte boundary
+#   ...       the chart's arrays, as in a chart file (see chart_file.py), notes long
+#   ...       zero padding to an 8-byte boundary
+#   float64   times[events]    song time of each key event, on the game clock
+#   int8      lanes[events]
+#   int8      down[events]     1 for a press, 0 for a release
+REPLAY_MAGIC = b"BTREPLAY"
+REPLAY_VERSION = 1
+REPLAY_EXTENSION = ".btr"
+
+PREAMBLE = struct.Struct("<8sII")
+EVENT_ARRAYS = (("times", np.dtype("<f8")), ("lanes", np.dtype("i1")), ("down", np.dtype("i1")))
+
+def is_replay_file(path):
+    return isinstance(path, str) and path.lower().endswith(REPLAY_EXTENSION)
+
+# Key events of one song, appended as they arrive. array.array keeps each append
+# cheap and the whole recording compact.
+class InputRecorder:
+    def __init__(self):
+        self.times = array("d")
+        self.lanes = array("b")
+        self.down = array("b")
+
+    def __len__(self):
+        return len(self.times)
+
+    def record(self, now, lane, down):
+        self.times.append(now)
+        self.lanes.append(lane)
+        self.down.append(1 if down else 0)
+
+    def clear(self):
+        del self.times[:], self.lanes[:], self.down[:]
+
+def save_replay(path, timeline, recorder, song_path, song_hash, difficulty, offset):
+    header = json.dumps({
+        "song_path": song_path,
+        "song_hash": song_hash,
+        "difficulty": difficulty,
+        "offset": offset,
+        "notes": len(timeline),
+        "events": len(recorder),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }).encode()
+    preamble = PREAMBLE.pack(REPLAY_MAGIC, REPLAY_VERSION, len(header))
+    padding = -(len(preamble) + len(header)) % 8
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(preamble)
+        f.write(header)
+        f.write(b"\0" * padding)
+        for name, dtype in CHART_ARRAYS:
+            f.write(np.ascontiguousarray(getattr(timeline, name), dtype=dtype).tobytes())
+        f.write(b"\0" * (-f.tell() % 8))
+        for name, dtype in EVENT_ARRAYS:
+            f.write(np.asarray(getattr(recorder, name), dtype=dtype).tobytes())
+    os.replace(tmp_path, path)
+
+# Saves into REPLAY_DIR as "<song>-<difficulty>-<time>.btr" and returns the path
+def save_session_replay(timeline, recorder, song_path, song_hash, difficulty, offset):
+    os.makedirs(REPLAY_DIR, exist_ok=True)
+    name = f"{os.path.splitext(os.path.basename(song_path))[0]}-{difficulty}-{time.strftime('%Y%m%d-%H%M%S')}"
+    path = os.path.join(REPLAY_DIR, name + REPLAY_EXTENSION)
+    save_replay(path, timeline, recorder, song_path, song_hash, difficulty, offset)
+    return path
+
+# Returns (header, NoteTimeline, events) where events maps times/lanes/down to arrays
+def load_replay(path):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    magic, version, header_length = PREAMBLE.unpack_from(data)
+    if magic != REPLAY_MAGIC:
+        raise ValueError(f"{path} is not a replay file")
+    if version != REPLAY_VERSION:
+        raise ValueError(f"{path} has replay format version {version}, expected {REPLAY_VERSION}")
+    header_end = PREAMBLE.size + header_length
+    header = json.loads(data[PREAMBLE.size:header_end])
+
+    offset = header_end + (-header_end % 8)
+    chart, events = {}, {}
+    for arrays, names, count in ((chart, CHART_ARRAYS, header["notes"]), (events, EVENT_ARRAYS, header["events"])):
+        for name, dtype in names:
+            arrays[name] = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+            offset += count * dtype.itemsize
+        offset += -offset % 8
+
+    timeline = NoteTimeline(chart["times"], chart["lanes"], chart["chord_sizes"], chart["pitches"])
+    return header, timeline, events
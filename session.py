@@ -0,0 +1,25 @@
+from collections import deque
+
+# Songs to play back to back, each with its own difficulty and optionally only a
+# section of it (start and duration in seconds; duration None plays to the end).
+# The game takes songs from the front; peek shows which one is coming so it can
+# be prefetched while the current one plays (see ChartLoader.prefetch).
+class SongQueue:
+    def __init__(self, songs=(), difficulty="medium"):
+        self.entries = deque((song_path, difficulty, 0.0, None) for song_path in songs)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, song_path, difficulty, start=0.0, duration=None):
+        self.entries.append((song_path, difficulty, start, duration))
+
+    def peek(self):
+        return self.entries[0] if self.entries else None
+
+    # Removes and returns the next (song_path, difficulty, start, duration), or None when empty
+    def next(self):
+        return self.entries.popleft() if self.entries else None
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,155 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from audio_handling import DEFAULT_PROFILE, PROFILES
+from chart import DIFFICULTIES, NoteTimeline
+from chart_cache import get_song_data_cached
+from chart_file import is_chart_file, load_chart
+from chart_loader import build_timelines
+from game_state import GameState
+from judgement import LATE_WINDOW, MISS_WINDOW
+from prepare_charts import find_songs
+from replay import is_replay_file, load_replay
+
+# Plays charts without a window, as fast as the game logic runs. The same
+# GameState the game uses is driven by a stream of key presses instead of a clock,
+# either synthetic ones or the presses recorded in a replay file (see replay.py):
+# before each press everything up to its time is spawned and expired, then the
+# press is judged. Notes only need to be queued by the time a press could hit
+# them, so they spawn MISS_WINDOW early instead of a whole screen early.
+#
+#   python simulate.py ~/Music -d hard --jitter-ms 20 --miss-rate 0.05 -o results.jsonl
+#   python simulate.py ~/.beattrack/replays/field-medium-20240101-120000.btr --judgements
+
+# Presses for every note in a timeline: each note is pressed `offset` seconds late
+# plus normally distributed jitter, except a `miss_rate` fraction that is skipped
+def synthetic_presses(timeline, offset=0.0, jitter=0.0, miss_rate=0.0, seed=0):
+    rng = np.random.default_rng(seed)
+    keep = rng.random(len(timeline)) >= miss_rate
+    times = timeline.times[keep] + offset + rng.normal(0.0, jitter, keep.sum())
+    lanes = timeline.lanes[keep]
+    order = np.argsort(times, kind="stable")
+    return times[order], lanes[order]
+
+# Plays `timeline` with presses at `press_times` in `press_lanes` (sorted by time)
+# and returns the final GameState. If `judgements` is a list, (time, lane,
+# judgement, error) is appended to it for every press; presses that hit nothing
+# have judgement and error None.
+def simulate(timeline, press_times, press_lanes, judgements=None):
+    state = GameState(travel_time=MISS_WINDOW, linger=LATE_WINDOW, num_lanes=4)
+    state.add_timeline(timeline)
+    for now, lane in zip(np.asarray(press_times).tolist(), np.asarray(press_lanes).tolist()):
+        state.advance(now)
+        result = state.press(lane, now)
+        if judgements is not None:
+            judgements.append((now, lane) + (result[:2] if result is not None else (None, None)))
+
+    # Run past the last note so everything left over is scored as a miss
+    end = timeline.times[-1] if len(timeline) else 0.0
+    state.advance(end + LATE_WINDOW + state.linger + 1.0)
+    return state
+
+def summarize(state):
+    counts, edges = state.error_histogram()
+    errors = np.asarray(state.errors)
+    return {
+        "notes": len(state.chart()),
+        "score": state.score,
+        "misses": state.score["miss"],
+        "max_combo": state.max_combo,
+        "accuracy": round(state.accuracy(), 3),
+        "error_mean_ms": round(float(errors.mean()) * 1000, 3) if len(errors) else None,
+        "error_std_ms": round(float(errors.std()) * 1000, 3) if len(errors) else None,
+        "histogram": {"edges_ms": np.round(edges * 1000, 3).tolist(), "counts": counts.tolist()},
+    }
+
+# The chart the game would play for a song (or chart file) without streaming
+def load_timeline(path, difficulty, profile=DEFAULT_PROFILE):
+    if is_chart_file(path):
+        header, timeline = load_chart(path)
+        return timeline
+    song_data = get_song_data_cached(path, difficulty, profile=profile)
+    timelines = list(build_timelines([song_data] if song_data is not None else [], difficulty))
+    return NoteTimeline.concatenate(timelines) if timelines else NoteTimeline([], [], [], [])
+
+def simulate_chart(path, difficulty, profile, offset, jitter, miss_rate, seed, log=False):
+    if is_replay_file(path):
+        header, timeline, events = load_replay(path)
+        down = events["down"] == 1
+        presses = events["times"][down], events["lanes"][down]
+        difficulty = header["difficulty"]
+    else:
+        timeline = load_timeline(path, difficulty, profile)
+        presses = synthetic_presses(timeline, offset, jitter, miss_rate, seed)
+
+    judgements = [] if log else None
+    start = time.perf_counter()
+    state = simulate(timeline, *presses, judgements)
+    elapsed = time.perf_counter() - start
+    result = {"difficulty": difficulty, **summarize(state)}
+    if log:
+        result["judgements"] = judgements
+    return result, elapsed
+
+def find_charts(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            yield from find_songs(path)
+        else:
+            yield path
+
+def main():
+    parser = argparse.ArgumentParser(description="Play charts headlessly with synthetic input and report scores.")
+    parser.add_argument("paths", nargs="+", help="songs, chart files, replay files or directories of songs")
+    parser.add_argument("-d", "--difficulty", choices=DIFFICULTIES, default="medium")
+    parser.add_argument("-p", "--profile", choices=PROFILES, default=DEFAULT_PROFILE, help="analysis profile")
+    # Synthetic presses, for songs and chart files
+    parser.add_argument("--offset-ms", type=float, default=0.0, help="average lateness of every press")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="standard deviation of press timing")
+    parser.add_argument("--miss-rate", type=float, default=0.0, help="fraction of notes never pressed")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--judgements", action="store_true", help="include (time, lane, judgement, error) per press")
+    parser.add_argument("-o", "--output", help="JSON lines file to write (default: stdout)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    charts = list(find_charts(args.paths))
+    out = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    failed = 0
+    notes = 0
+    simulated = 0.0
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(simulate_chart, path, args.difficulty, args.profile, args.offset_ms / 1000,
+                                   args.jitter_ms / 1000, args.miss_rate, args.seed, args.judgements): path
+                       for path in charts}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    result, elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"FAILED {path}: {e}", file=sys.stderr)
+                    continue
+                notes += result["notes"]
+                simulated += elapsed
+                out.write(json.dumps({"path": path, **result,
+                                      "seconds": round(elapsed, 4)}) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    wall = time.perf_counter() - start
+    rate = notes / simulated if simulated > 0 else 0.0
+    print(f"simulated {len(charts) - failed}, failed {failed} in {wall:.1f}s ({notes} notes, "
+          f"{rate:.0f} notes/s of game logic)", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from audio_handling import DEFAULT_PROFILE, PROFILES, vocal_scores
+from prepare_charts import find_songs
+
+# Tags every song under a directory as vocal or instrumental from a few short
+# excerpts per song, one song per worker process. Writes one JSON object per line.
+#
+#   python tag_vocals.py ~/Music --jobs 8 -o vocals.jsonl
+
+def tag_song(audio_path, excerpts, excerpt_length, profile):
+    start = time.perf_counter()
+    scores = vocal_scores(audio_path, excerpts, excerpt_length, profile)
+    return scores, time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description="Tag songs under a directory as vocal or instrumental.")
+    parser.add_argument("library", help="directory to scan for audio files")
+    parser.add_argument("-o", "--output", help="JSON lines file to write (default: stdout)")
+    parser.add_argument("-p", "--profile", choices=PROFILES, default=DEFAULT_PROFILE, help="analysis profile")
+    parser.add_argument("-n", "--excerpts", type=int, default=3, help="excerpts per song")
+    parser.add_argument("-l", "--excerpt-length", type=float, default=10.0, help="excerpt length in seconds")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args()
+
+    songs = list(find_songs(args.library))
+    out = open(args.output, "w") if args.output else sys.stdout
+    start = time.perf_counter()
+    failed = 0
+    try:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(tag_song, path, args.excerpts, args.excerpt_length, args.profile): path
+                       for path in songs}
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    scores, elapsed = future.result()
+                except Exception as e:
+                    failed += 1
+                    print(f"FAILED {path}: {e}", file=sys.stderr)
+                    continue
+                out.write(json.dumps({"path": path, **scores, "seconds": round(elapsed, 3)}) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    wall = time.perf_counter() - start
+    print(f"tagged {len(songs) - failed}, failed {failed} in {wall:.1f}s", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+import numpy as np
+
+FREE = 0
+ACTIVE = 1
+
+# Struct-of-arrays store for the tiles currently on screen. Each slot has a lane,
+# the song time its note should be hit, a y position (derived from that time every
+# frame), a state and a serial number that is unique per spawned tile (so
+# something holding on to a slot can tell whether it has been reused); free slots
+# are kept on a stack so spawning and despawning are O(1). When every slot is taken
+# the arrays double in size instead of dropping the note, and the caller is
+# expected to create drawing instructions for the new slots (see
+# MainWidget.ensure_tile_instructions).
+class TilePool:
+    def __init__(self, capacity=32):
+        self.lane = np.zeros(capacity, dtype=np.int8)
+        self.time = np.zeros(capacity, dtype=np.float64)
+        self.y = np.zeros(capacity, dtype=np.float64)
+        self.state = np.zeros(capacity, dtype=np.uint8)
+        self.serial = np.full(capacity, -1, dtype=np.int64)
+        self.free = list(range(capacity - 1, -1, -1))
+        self.next_serial = 0
+
+    @property
+    def capacity(self):
+        return len(self.state)
+
+    def __len__(self):
+        return self.capacity - len(self.free)
+
+    def spawn(self, lane, time):
+        if not self.free:
+            self.grow()
+        slot = self.free.pop()
+        self.lane[slot] = lane
+        self.time[slot] = time
+        self.state[slot] = ACTIVE
+        self.serial[slot] = self.next_serial
+        self.next_serial += 1
+        return slot
+
+    def is_alive(self, slot, serial):
+        return self.state[slot] == ACTIVE and self.serial[slot] == serial
+
+    def despawn(self, slot):
+        self.state[slot] = FREE
+        self.free.append(slot)
+
+    def active(self):
+        return np.flatnonzero(self.state == ACTIVE)
+
+    def grow(self):
+        old = self.capacity
+        new = max(old * 2, 1)
+        self.lane = np.resize(self.lane, new)
+        self.time = np.resize(self.time, new)
+        self.y = np.resize(self.y, new)
+        self.state = np.concatenate([self.state, np.zeros(new - old, dtype=np.uint8)])
+        self.serial = np.concatenate([self.serial, np.full(new - old, -1, dtype=np.int64)])
+        self.free.extend(range(new - 1, old - 1, -1))
+
+    def clear(self):
+        self.state[:] = FREE
+        self.free = list(range(self.capacity - 1, -1, -1))